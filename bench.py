@@ -0,0 +1,286 @@
+
+import sys
+import json
+import random
+import tracemalloc
+from time import perf_counter
+from argparse import ArgumentParser
+
+from main import (
+    CHAT_ID,
+    EVENT,
+    CHATS,
+    CONTACTS,
+
+    Date,
+    Post,
+    PostStore,
+    find_post,
+    find_posts,
+    select_posts,
+    parse_post_footer,
+    dynamo_parse_post,
+    dynamo_format_post,
+    format_posts_snapshot,
+    parse_posts_snapshot,
+    message_url,
+)
+
+
+# Pure hot path functions on synthetic data. Report ops/sec and
+# allocations, save JSON, compare with baseline
+#
+#   python bench.py --output bench.json
+#   python bench.py --baseline bench.json
+
+
+#######
+#
+#   DATA
+#
+######
+
+
+SCALES = [100, 1_000, 10_000, 100_000, 1_000_000]
+
+# Short reply, max Telegram message
+TEXT_SIZES = [32, 4096]
+
+WORDS = 'шад выпускники эвент чат контакты лекция ссылка привет'.split()
+
+
+def random_text(rand, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rand.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def make_text(rand, size, footer):
+    # Footer is last line of post
+    text = random_text(rand, size)
+    if footer:
+        footer = '\n#event 2022-07-09'
+        text = text[:size - len(footer)] + footer
+    return text
+
+
+def make_posts(rand, size):
+    # Mostly events, few nav posts, as in chat
+    posts = []
+    for message_id in range(1, size + 1):
+        if rand.random() < 0.9:
+            event_date = Date.fromordinal(
+                Date(2020, 1, 1).toordinal() + rand.randrange(5 * 365)
+            )
+            post = Post(message_id, EVENT, event_date)
+        else:
+            post = Post(message_id, rand.choice([CHATS, CONTACTS]))
+        posts.append(post)
+    return posts
+
+
+#######
+#
+#   MEASURE
+#
+#####
+
+
+def measure_ops(call, min_time, repeat):
+    # Grow number until run takes min_time, best of repeat
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            call()
+        elapsed = perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = perf_counter()
+        for _ in range(number):
+            call()
+        best = min(best, perf_counter() - start)
+    return number / best
+
+
+def measure_allocs(call, number):
+    # Peak is temporary memory inside call, net is what stays
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(number):
+            call()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'peak_bytes': peak - current,
+        'net_bytes': (after - current) // number,
+    }
+
+
+def run_bench(call, min_time, repeat):
+    ops = measure_ops(call, min_time, repeat)
+
+    # tracemalloc slows calls several times, keep run short. Building
+    # store of 1M posts runs once
+    number = max(1, min(100, int(ops * min_time / 10)))
+
+    result = {'ops': ops}
+    result.update(measure_allocs(call, number))
+    return result
+
+
+#######
+#
+#   BENCHES
+#
+######
+
+
+def footer_benches(rand):
+    for size in TEXT_SIZES:
+        for footer in [False, True]:
+            text = make_text(rand, size, footer)
+            name = f'parse_post_footer[size={size},footer={int(footer)}]'
+            yield name, lambda text=text: parse_post_footer(text)
+
+
+def post_benches(rand, size):
+    posts = make_posts(rand, size)
+    store = PostStore(posts)
+    message_id = rand.randrange(1, size + 1)
+    start = Date(2022, 7, 9)
+
+    yield f'post_store[n={size}]', lambda: PostStore(posts)
+    yield f'find_post_id[n={size}]', lambda: find_post(
+        store, message_id=message_id
+    )
+    yield f'find_post_type[n={size}]', lambda: find_post(
+        store, type=CHATS
+    )
+    yield f'find_posts_type[n={size}]', lambda: list(find_posts(
+        store, type=CONTACTS
+    ))
+    yield f'select_posts_nav[n={size}]', lambda: select_posts(
+        store, CHATS, limit=1
+    )
+    yield f'select_posts_future[n={size}]', lambda: select_posts(
+        store, EVENT, start=start, limit=3
+    )
+    yield f'select_events_month[n={size}]', lambda: store.select_events(
+        start, Date(2022, 8, 9)
+    )
+
+    data = format_posts_snapshot(store)
+    yield f'format_posts_snapshot[n={size}]', lambda: format_posts_snapshot(
+        store
+    )
+    yield f'parse_posts_snapshot[n={size}]', lambda: parse_posts_snapshot(
+        data
+    )
+
+
+def dynamo_benches(rand):
+    post = Post(5614, EVENT, Date(2022, 7, 9))
+    item = dynamo_format_post(post)
+    yield 'dynamo_format_post', lambda: dynamo_format_post(post)
+    yield 'dynamo_parse_post', lambda: dynamo_parse_post(item)
+    yield 'message_url', lambda: message_url(CHAT_ID, 5614)
+
+
+def benches(scales, rand):
+    yield from footer_benches(rand)
+    yield from dynamo_benches(rand)
+    for size in scales:
+        yield from post_benches(rand, size)
+
+
+#######
+#
+#   BASELINE
+#
+#####
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        ratio = result['ops'] / base['ops']
+        if ratio < 1 - threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+#######
+#
+#   MAIN
+#
+#####
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--scales', type=int, nargs='+', default=SCALES,
+        help='number of posts'
+    )
+    parser.add_argument('--filter', help='run benches with substring')
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results JSON')
+    parser.add_argument('--baseline', help='compare with results JSON')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='flag ops/sec drop more than fraction'
+    )
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    results = {}
+    for name, call in benches(args.scales, rand):
+        if args.filter and args.filter not in name:
+            continue
+
+        result = run_bench(call, args.min_time, args.repeat)
+        results[name] = result
+        print(
+            f'{name:50} {result["ops"]:14.1f} ops/s '
+            f'{result["peak_bytes"]:12} peak '
+            f'{result["net_bytes"]:8} net',
+            flush=True
+        )
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'python': sys.version,
+                'results': results,
+            }, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, ratio in regressions:
+            print(f'Regression {name}: {ratio:.2f}x baseline')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+
+import sys
+import json
+import random
+import asyncio
+import logging
+import resource
+from time import perf_counter
+from argparse import ArgumentParser
+
+from aiohttp.test_utils import (
+    TestServer,
+    TestClient
+)
+
+from main import (
+    CHAT_ID,
+    EVENT,
+    CHATS,
+    CONTACTS,
+    WHOIS_HOWTO,
+
+    START_COMMAND,
+    FUTURE_EVENTS_COMMAND,
+    CHATS_COMMAND,
+    CONTACTS_COMMAND,
+    WHOIS_HOWTO_COMMAND,
+
+    ChatMemberStatus,
+    Bot,
+    BotContext,
+    MemoryDB,
+    FaultyDB,
+    memory_sizes,
+    Date,
+    Post,
+    WEBHOOK_PATH,
+    log,
+)
+
+
+# Load test webhook end to end. Synthetic updates, POST concurrently
+# to app from make_app, bot and DB in memory with artificial latency.
+# Report throughput, latency percentiles per kind of update, peak RSS,
+# sizes of caches and queues after run
+#
+#   python load.py --updates 10000 --concurrency 16
+#   python load.py --db-latency 0.02 --tg-latency 0.1 --json load.json
+#
+# Webhook reply mode answers after handler is done, so POST latency
+# is handler latency. With UPDATE_WORKERS POST latency is only queue
+# put
+
+
+#######
+#
+#   BOT
+#
+#####
+
+
+# No requests to Telegram. Sleep like network, answer minimal JSON.
+# Users with id below members are chat members
+
+
+class LoadBot(Bot):
+    def __init__(self, token, latency, members, rand):
+        Bot.__init__(self, token)
+        self.latency = latency
+        self.members = members
+        self.rand = rand
+        self.calls = {}
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.rand.expovariate(1 / self.latency))
+
+        if method == 'getChatMember':
+            user_id = int(data['user_id'])
+            status = ChatMemberStatus.MEMBER
+            if user_id >= self.members:
+                status = ChatMemberStatus.LEFT
+            return {
+                'status': status,
+                'user': {'id': user_id, 'is_bot': False, 'first_name': 'A'}
+            }
+
+        if method in ('sendMessage', 'forwardMessage'):
+            return {'message_id': self.calls[method]}
+
+        return True
+
+
+class LoadBotContext(BotContext):
+    def __init__(self, bot, db):
+        BotContext.__init__(self, bot=bot, db=db, webhook_reply=True)
+
+
+def seed_posts(db, rand, events):
+    # Nav posts plus events around today
+    message_id = 1
+    for type in (CHATS, CONTACTS, WHOIS_HOWTO):
+        db.posts.put(Post(message_id, type))
+        message_id += 1
+
+    today = Date.today().toordinal()
+    for _ in range(events):
+        event_date = Date.fromordinal(today + rand.randrange(-365, 60))
+        db.posts.put(Post(message_id, EVENT, event_date))
+        message_id += 1
+    return message_id
+
+
+#######
+#
+#   UPDATES
+#
+######
+
+
+CHAT = 'chat'
+EDIT = 'edit'
+MEMBER_COMMAND = 'member'
+STRANGER_COMMAND = 'stranger'
+CHAT_MEMBER = 'chat_member'
+
+MIX = {
+    CHAT: 0.5,
+    EDIT: 0.15,
+    MEMBER_COMMAND: 0.25,
+    STRANGER_COMMAND: 0.08,
+    CHAT_MEMBER: 0.02,
+}
+
+COMMANDS = [
+    START_COMMAND,
+    FUTURE_EVENTS_COMMAND,
+    CHATS_COMMAND,
+    CONTACTS_COMMAND,
+    WHOIS_HOWTO_COMMAND,
+]
+
+CHAT_TEXTS = [
+    'Привет',
+    'Кто идет на встречу в пятницу?',
+    'Встреча выпускников\n\n#event {date}',
+    'Чаты выпускников\n\n#chats',
+    'Длинное сообщение ' * 200,
+]
+
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'A'}
+
+
+CHAT_JSON = {
+    'id': CHAT_ID,
+    'title': 'shad',
+    'type': 'supergroup'
+}
+
+
+class UpdateStream:
+    def __init__(self, rand, members, strangers, message_id):
+        self.rand = rand
+        self.members = members
+        self.strangers = strangers
+        self.update_id = 0
+        self.message_id = message_id
+        self.chat_ids = []
+
+    def member_id(self):
+        return self.rand.randrange(self.members)
+
+    def stranger_id(self):
+        return self.members + self.rand.randrange(self.strangers)
+
+    def chat_text(self):
+        date = Date.fromordinal(
+            Date.today().toordinal() + self.rand.randrange(60)
+        )
+        text = self.rand.choice(CHAT_TEXTS)
+        return text.format(date=date.isoformat())
+
+    def chat_message(self, message_id):
+        return {
+            'message_id': message_id,
+            'from': user_json(self.member_id()),
+            'chat': CHAT_JSON,
+            'date': 1657879275,
+            'text': self.chat_text(),
+        }
+
+    def command_message(self, user_id):
+        command = self.rand.choice(COMMANDS)
+        text = f'/{command}'
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'from': user_json(user_id),
+            'chat': dict(user_json(user_id), type='private'),
+            'date': 1657879275,
+            'text': text,
+            'entities': [{
+                'type': 'bot_command',
+                'offset': 0,
+                'length': len(text)
+            }],
+        }
+        return command, message
+
+    def next(self):
+        kind = self.rand.choices(list(MIX), list(MIX.values()))[0]
+        if kind == EDIT and not self.chat_ids:
+            kind = CHAT
+
+        self.update_id += 1
+        update = {'update_id': self.update_id}
+        label = kind
+
+        if kind == CHAT:
+            self.message_id += 1
+            self.chat_ids.append(self.message_id)
+            update['message'] = self.chat_message(self.message_id)
+
+        elif kind == EDIT:
+            # Recent messages are edited more
+            index = len(self.chat_ids) - 1 - min(
+                int(self.rand.expovariate(0.2)),
+                len(self.chat_ids) - 1
+            )
+            message = self.chat_message(self.chat_ids[index])
+            message['edit_date'] = 1657879298
+            update['edited_message'] = message
+
+        elif kind in (MEMBER_COMMAND, STRANGER_COMMAND):
+            user_id = (
+                self.member_id() if kind == MEMBER_COMMAND
+                else self.stranger_id()
+            )
+            command, message = self.command_message(user_id)
+            update['message'] = message
+            label = f'{kind} /{command}'
+
+        elif kind == CHAT_MEMBER:
+            user = user_json(self.stranger_id())
+            update['chat_member'] = {
+                'chat': CHAT_JSON,
+                'from': user,
+                'date': 1657879275,
+                'old_chat_member': {'user': user, 'status': 'left'},
+                'new_chat_member': {'user': user, 'status': 'member'},
+            }
+
+        return label, update
+
+
+#######
+#
+#   REPORT
+#
+#####
+
+
+def percentile(values, fraction):
+    # Nearest rank, values sorted
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': values[-1],
+    }
+
+
+def format_report(report):
+    lines = [
+        f'{report["updates"]} updates in {report["elapsed"]:.2f}s, '
+        f'{report["throughput"]:.1f} updates/s, '
+        f'{report["errors"]} errors, '
+        f'peak RSS {report["max_rss_kb"] // 1024}MB',
+        '',
+        f'{"kind":32} {"count":>7} {"p50":>8} {"p95":>8} '
+        f'{"p99":>8} {"max":>8}'
+    ]
+    for label, stats in sorted(report['kinds'].items()):
+        lines.append(
+            f'{label:32} {stats["count"]:7} '
+            + ' '.join(
+                f'{stats[_] * 1000:7.1f}ms'
+                for _ in ('p50', 'p95', 'p99', 'max')
+            )
+        )
+    lines.append('')
+    lines.append(f'Telegram calls {report["telegram_calls"]}')
+    lines.append(f'DB calls {report["db_calls"]}')
+    lines.append(f'Sizes {report["sizes"]}')
+    return '\n'.join(lines)
+
+
+#######
+#
+#   RUN
+#
+#####
+
+
+async def load(args):
+    rand = random.Random(args.seed)
+
+    bot = LoadBot('123:loadtoken', args.tg_latency, args.members, rand)
+    db = MemoryDB()
+    message_id = seed_posts(db, rand, args.events)
+    db = FaultyDB(db, args.db_latency, args.db_errors, args.seed)
+
+    context = LoadBotContext(bot, db)
+    context.setup_handlers()
+    context.setup_middlewares()
+
+    stream = UpdateStream(rand, args.members, args.strangers, message_id)
+    updates = [stream.next() for _ in range(args.updates)]
+
+    latencies = {}
+    errors = 0
+
+    server = TestServer(context.make_app())
+    async with TestClient(server) as client:
+        queue = asyncio.Queue()
+        for item in updates:
+            queue.put_nowait(item)
+
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                label, update = queue.get_nowait()
+                start = perf_counter()
+                response = await client.post(WEBHOOK_PATH, json=update)
+                await response.read()
+                latency = perf_counter() - start
+
+                if response.status != 200:
+                    errors += 1
+                latencies.setdefault(label, []).append(latency)
+
+        start = perf_counter()
+        await asyncio.gather(*[
+            worker() for _ in range(args.concurrency)
+        ])
+        elapsed = perf_counter() - start
+        sizes = dict(memory_sizes(context))
+
+    return {
+        'updates': args.updates,
+        'concurrency': args.concurrency,
+        'elapsed': elapsed,
+        'throughput': args.updates / elapsed,
+        'errors': errors,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'kinds': {
+            label: summarize(values)
+            for label, values in latencies.items()
+        },
+        'telegram_calls': bot.calls,
+        'db_calls': db.calls,
+        'sizes': sizes,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument(
+        '--concurrency', type=int, default=16,
+        help='parallel POSTs, as container --concurrency'
+    )
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--strangers', type=int, default=100)
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument(
+        '--db-latency', type=float, default=0.01,
+        help='mean DB call latency, seconds'
+    )
+    parser.add_argument(
+        '--db-errors', type=float, default=0,
+        help='fraction of failed DB calls'
+    )
+    parser.add_argument(
+        '--tg-latency', type=float, default=0.05,
+        help='mean Telegram API latency, seconds'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write report JSON')
+    parser.add_argument(
+        '--log-level', default='WARNING',
+        help='bot log level, INFO logs every update'
+    )
+    args = parser.parse_args()
+    log.setLevel(logging.getLevelName(args.log_level))
+
+    report = asyncio.run(load(args))
+    print(format_report(report))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if report['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
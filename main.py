@@ -1,18 +1,39 @@
 
 import re
+import sys
+import json
+import zlib
 import logging
-from os import getenv
+import asyncio
+import resource
+import threading
+import tracemalloc
+from os import (
+    getenv,
+    sysconf
+)
+from os.path import basename
+from argparse import ArgumentParser
 from dataclasses import dataclass
 from datetime import (
     date as Date,
     datetime as Datetime,
 )
+from time import monotonic
+from random import Random
+from bisect import (
+    bisect_left,
+    insort
+)
 from contextlib import AsyncExitStack
+from collections import (
+    OrderedDict,
+    deque
+)
 
 from aiogram import (
     Bot,
     Dispatcher,
-    executor
 )
 from aiogram.types import (
     ChatType,
@@ -20,14 +41,23 @@ from aiogram.types import (
     BotCommand,
 )
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import (
+    BOT_DISPATCHER_KEY,
+    WebhookRequestHandler,
+    SendMessage,
+)
 from aiogram.dispatcher.handler import CancelHandler
 from aiogram.utils.exceptions import (
     BadRequest,
+    RetryAfter,
     MessageToForwardNotFound,
     MessageIdInvalid,
 )
 
+from aiohttp import web
+
 import aiobotocore.session
+from botocore.exceptions import ClientError
 
 
 #######
@@ -58,11 +88,148 @@ CHAT_ID = int(getenv('CHAT_ID'))
 
 LOG_LEVEL = getenv('LOG_LEVEL', logging.INFO)
 
+# Opt-in profiling. Log top functions for PROFILE_RATE fraction of
+# updates and for any update slower than PROFILE_SLOW seconds
+PROFILE_RATE = float(getenv('PROFILE_RATE', 0))
+PROFILE_SLOW = float(getenv('PROFILE_SLOW', 0))
+PROFILE_TOP = int(getenv('PROFILE_TOP', 10))
+
 log = logging.getLogger(__name__)
 log.setLevel(LOG_LEVEL)
 log.addHandler(logging.StreamHandler())
 
 
+######
+#
+#   METRICS
+#
+#######
+
+# Where update time goes: middlewares, handlers, Dynamo, Telegram
+# API. Fixed bucket histograms, observe is bisect plus few adds,
+# cheap enough to leave on. Prometheus text on /metrics
+
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Histogram:
+    def __init__(self, name, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+
+        # labels values -> [bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if not series:
+            series = [0] * (len(self.buckets) + 2)
+            self.series[labels] = series
+
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def format(self):
+        yield f'# TYPE {self.name} histogram'
+        for labels, series in sorted(self.series.items()):
+            pairs = [
+                f'{key}="{value}"'
+                for key, value in zip(self.labels, labels)
+            ]
+
+            count = 0
+            buckets = [*self.buckets, '+Inf']
+            for bucket, number in zip(buckets, series):
+                count += number
+                tags = ','.join([*pairs, f'le="{bucket}"'])
+                yield f'{self.name}_bucket{{{tags}}} {count}'
+
+            tags = ','.join(pairs)
+            yield f'{self.name}_sum{{{tags}}} {series[-1]}'
+            yield f'{self.name}_count{{{tags}}} {count}'
+
+
+class Timer:
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic()
+
+    def __exit__(self, *_):
+        self.histogram.observe(monotonic() - self.start, *self.labels)
+
+
+MIDDLEWARE_SECONDS = Histogram(
+    'middleware_seconds',
+    ('middleware', 'action')
+)
+HANDLER_SECONDS = Histogram('handler_seconds', ('handler',))
+DYNAMO_SECONDS = Histogram('dynamo_seconds', ('operation', 'table'))
+TELEGRAM_SECONDS = Histogram('telegram_seconds', ('method',))
+
+HISTOGRAMS = [
+    MIDDLEWARE_SECONDS,
+    HANDLER_SECONDS,
+    DYNAMO_SECONDS,
+    TELEGRAM_SECONDS,
+]
+
+
+def timed_handler(handler):
+    # aiogram passes extra kwargs by handler spec, keep (context,
+    # obj) signature
+
+    name = handler.__name__
+
+    async def wrapper(context, obj):
+        with Timer(HANDLER_SECONDS, name):
+            return await handler(context, obj)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def time_handlers(cls):
+    for name, handler in list(vars(cls).items()):
+        if name.startswith('handle_'):
+            setattr(cls, name, timed_handler(handler))
+
+
+class TimedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        with Timer(TELEGRAM_SECONDS, method):
+            return await Bot.request(self, method, data, files, **kwargs)
+
+
+# Counters and gauges read at scrape time, from numbers already kept
+# by caches and queues. Counters only grow, rate() works on them
+# across container restarts
+
+
+def format_values(type, values):
+    for name, value in values:
+        yield f'# TYPE {name} {type}'
+        yield f'{name} {value}'
+
+
+def format_metrics(counters, gauges):
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.format())
+    lines.extend(format_values('counter', counters))
+    lines.extend(format_values('gauge', gauges))
+    lines.append('')
+    return '\n'.join(lines)
+
+
 #######
 #
 #   OBJ
@@ -90,18 +257,126 @@ class Post:
     event_date: Date = None
 
 
+# Index by message_id and by type. Ids increase with time, so last id
+# in type index is latest post. Events also sorted by date
+
+
+class PostStore:
+    def __init__(self, posts=()):
+        self.posts = {}
+        self.types = {}
+        self.events = []
+
+        # Bulk load, sort once. Insort per post is quadratic on
+        # events in random date order
+        for post in posts:
+            self.posts.pop(post.message_id, None)
+            self.posts[post.message_id] = post
+        for post in self.posts.values():
+            self.types.setdefault(post.type, []).append(post.message_id)
+            if post.type == EVENT and post.event_date:
+                self.events.append((post.event_date, post.message_id))
+        for ids in self.types.values():
+            ids.sort()
+        self.events.sort()
+
+    def __iter__(self):
+        return iter(self.posts.values())
+
+    def __len__(self):
+        return len(self.posts)
+
+    def get(self, message_id):
+        return self.posts.get(message_id)
+
+    def latest(self, type):
+        ids = self.types.get(type)
+        if ids:
+            return self.posts[ids[-1]]
+
+    def all(self, type):
+        ids = self.types.get(type, ())
+        return [self.posts[_] for _ in ids]
+
+    def newest(self, type, limit=None):
+        # Newest first, touch only limit ids from end
+        ids = self.types.get(type, ())
+        if limit is not None:
+            ids = ids[-limit:] if limit > 0 else ()
+        return [self.posts[_] for _ in reversed(ids)]
+
+    def select_events(self, start, stop=None, cap=None):
+        # start <= event_date < stop
+        lo = bisect_left(self.events, (start,))
+        hi = len(self.events)
+        if stop:
+            hi = bisect_left(self.events, (stop,), lo)
+        if cap is not None:
+            hi = min(hi, lo + cap)
+        return [
+            self.posts[message_id]
+            for _, message_id in self.events[lo:hi]
+        ]
+
+    def put(self, post):
+        self.delete(post.message_id)
+        self.posts[post.message_id] = post
+        ids = self.types.setdefault(post.type, [])
+        insort(ids, post.message_id)
+
+        if post.type == EVENT and post.event_date:
+            insort(self.events, (post.event_date, post.message_id))
+
+    def delete(self, message_id):
+        post = self.posts.pop(message_id, None)
+        if post:
+            ids = self.types[post.type]
+            del ids[bisect_left(ids, message_id)]
+
+            if post.type == EVENT and post.event_date:
+                key = (post.event_date, post.message_id)
+                del self.events[bisect_left(self.events, key)]
+
+
+def post_store(posts):
+    if isinstance(posts, PostStore):
+        return posts
+    return PostStore(posts)
+
+
 def find_posts(posts, message_id=None, type=None):
-    for post in posts:
-        if (
-                message_id and post.message_id == message_id
-                or type and post.type == type
-        ):
+    posts = post_store(posts)
+    if message_id:
+        post = posts.get(message_id)
+        if post:
             yield post
 
+    if type:
+        for post in posts.all(type):
+            if post.message_id != message_id:
+                yield post
+
+
+def find_post(posts, message_id=None, type=None):
+    posts = post_store(posts)
+    if message_id:
+        post = posts.get(message_id)
+        if post:
+            return post
+
+    if type:
+        return posts.latest(type)
+
 
-def find_post(posts, **kwargs):
-    for post in find_posts(posts, **kwargs):
-        return post
+# Newest first. For events with start, soonest from start first
+
+
+def select_posts(posts, type, start=None, limit=None):
+    posts = post_store(posts)
+    if type == EVENT and start:
+        return posts.select_events(start, cap=limit)
+
+    return posts.newest(type, limit)
 
 
 ######
@@ -175,7 +450,28 @@ async def dynamo_client():
     # https://github.com/aio-libs/aiobotocore/discussions/955
     exit_stack = AsyncExitStack()
     client = await exit_stack.enter_async_context(manager)
-    return exit_stack, client
+    return exit_stack, TimedDynamoClient(client)
+
+
+# Time every request, scan page is one request
+
+
+class TimedDynamoClient:
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        async def call(**kwargs):
+            table = kwargs.get('TableName')
+            if not table:
+                # batch_write_item
+                table = ','.join(kwargs.get('RequestItems', ()))
+            with Timer(DYNAMO_SECONDS, name, table):
+                return await method(**kwargs)
+
+        return call
 
 
 ######
@@ -187,20 +483,172 @@ S = 'S'
 N = 'N'
 
 
-async def dynamo_scan(client, table):
-    response = await client.scan(
-        TableName=table
-    )
-    return response['Items']
+# Scan returns at most 1MB per page, follow LastEvaluatedKey. With
+# segments > 1 scan table in parallel, merge pages as they come
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan
+
+DYNAMO_SCAN_SEGMENTS = int(getenv('DYNAMO_SCAN_SEGMENTS', 1))
+
+
+async def dynamo_pages(method, **kwargs):
+    while True:
+        response = await method(**kwargs)
+        yield response['Items']
+
+        key = response.get('LastEvaluatedKey')
+        if not key:
+            break
+        kwargs['ExclusiveStartKey'] = key
+
+
+async def dynamo_scan_pages(client, table, **kwargs):
+    async for items in dynamo_pages(
+            client.scan,
+            TableName=table,
+            **kwargs
+    ):
+        yield items
+
+
+async def dynamo_scan(client, table, segments=1):
+    if segments == 1:
+        async for items in dynamo_scan_pages(client, table):
+            for item in items:
+                yield item
+        return
+
+    # Bounded, segments wait while consumer is busy
+    queue = asyncio.Queue(maxsize=segments)
+
+    async def scan_segment(segment):
+        try:
+            async for items in dynamo_scan_pages(
+                    client, table,
+                    Segment=segment,
+                    TotalSegments=segments
+            ):
+                await queue.put(items)
+        except asyncio.CancelledError:
+            # Consumer is gone, no sentinel. Put on full queue would
+            # block cancel forever
+            raise
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    tasks = [
+        asyncio.create_task(scan_segment(_))
+        for _ in range(segments)
+    ]
+    try:
+        running = segments
+        while running:
+            items = await queue.get()
+            if items is None:
+                running -= 1
+                continue
+            for item in items:
+                yield item
+
+        # Raise segment errors
+        await asyncio.gather(*tasks)
+
+    finally:
+        # Consumer stopped early or failed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def dynamo_query(client, table, index, condition, names, values,
+                       forward=True, limit=None):
+    kwargs = {}
+    if limit:
+        kwargs['Limit'] = limit
+
+    count = 0
+    async for items in dynamo_pages(
+            client.query,
+            TableName=table,
+            IndexName=index,
+            KeyConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ScanIndexForward=forward,
+            **kwargs
+    ):
+        for item in items:
+            yield item
+            count += 1
+            if count == limit:
+                return
 
 
-async def dynamo_put(client, table, item):
+async def dynamo_put(client, table, item, condition=None,
+                     names=None, values=None):
+    kwargs = {}
+    if condition:
+        kwargs['ConditionExpression'] = condition
+    if names:
+        kwargs['ExpressionAttributeNames'] = names
+    if values:
+        kwargs['ExpressionAttributeValues'] = values
+
     await client.put_item(
         TableName=table,
-        Item=item
+        Item=item,
+        **kwargs
     )
 
 
+# BatchWriteItem takes up to 25 requests. Under load Dynamo returns
+# part of them in UnprocessedItems, retry those with backoff
+# https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchWriteItem.html
+
+DYNAMO_BATCH_SIZE = 25
+DYNAMO_BATCH_RETRIES = 5
+DYNAMO_BATCH_BACKOFF = 0.05
+
+
+class UnprocessedItems(Exception):
+    pass
+
+
+async def dynamo_batch_write(client, table, requests, concurrency=1):
+    requests = list(requests)
+    chunks = [
+        requests[index:index + DYNAMO_BATCH_SIZE]
+        for index in range(0, len(requests), DYNAMO_BATCH_SIZE)
+    ]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write(chunk):
+        async with semaphore:
+            items = {table: chunk}
+            for attempt in range(DYNAMO_BATCH_RETRIES + 1):
+                if attempt:
+                    await asyncio.sleep(
+                        DYNAMO_BATCH_BACKOFF * 2 ** attempt
+                    )
+
+                response = await client.batch_write_item(
+                    RequestItems=items
+                )
+                items = response.get('UnprocessedItems')
+                if not items:
+                    return
+
+            raise UnprocessedItems(len(items[table]))
+
+    await asyncio.gather(*[write(_) for _ in chunks])
+
+
+def is_condition_failed(error):
+    code = error.response['Error']['Code']
+    return code == 'ConditionalCheckFailedException'
+
+
 async def dynamo_get(client, table, key_name, key_type, key_value):
     response = await client.get_item(
         TableName=table,
@@ -257,234 +705,1365 @@ def dynamo_format_post(post):
 
 
 ######
-#   READ/WRITE
-######
-
-
-POSTS_TABLE = 'posts'
-MESSAGE_ID_KEY = 'message_id'
+#   SINGLE FLIGHT
+#####
 
+# Burst of same commands after announcement. Concurrent identical
+# reads await one shared request
 
-async def read_posts(db):
-    items = await dynamo_scan(db.client, POSTS_TABLE)
-    return [dynamo_parse_post(_) for _ in items]
 
+class SingleFlight:
+    def __init__(self):
+        self.pending = {}
 
-async def put_post(db, post):
-    item = dynamo_format_post(post)
-    await dynamo_put(db.client, POSTS_TABLE, item)
+        self.calls = 0
+        self.coalesced = 0
 
+    async def run(self, key, fetch):
+        self.calls += 1
+        task = self.pending.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fetch())
+            self.pending[key] = task
+            task.add_done_callback(
+                lambda _: self.pending.pop(key, None)
+            )
 
-async def delete_post(db, message_id):
-    await dynamo_delete(
-        db.client, POSTS_TABLE,
-        MESSAGE_ID_KEY, N, message_id
-    )
+        # Waiter cancelled, others still need result
+        return await asyncio.shield(task)
 
 
 ######
-#  DB
-#######
+#   CACHE
+#####
 
+# Working set is few hundred tiny posts, keep them in memory. Other
+# container instances may write to table, so rescan after TTL. TTL=0
+# disables cache
 
-class DB:
-    def __init__(self):
-        self.exit_stack = None
-        self.client = None
+POSTS_CACHE_TTL = float(getenv('POSTS_CACHE_TTL', 60))
 
-    async def connect(self):
-        self.exit_stack, self.client = await dynamo_client()
 
-    async def close(self):
-        await self.exit_stack.aclose()
+class PostsCache:
+    def __init__(self, ttl=POSTS_CACHE_TTL):
+        self.ttl = ttl
+        self.posts = None
+        self.expires = None
 
+        # Bumped on every write. Scan started before write may miss
+        # it, do not cache such scan
+        self.version = 0
 
-DB.read_posts = read_posts
-DB.put_post = put_post
-DB.delete_post = delete_post
+        self.hits = 0
+        self.misses = 0
 
+    def get(self):
+        if self.posts is not None and monotonic() < self.expires:
+            self.hits += 1
+            return self.posts
 
-#######
-#
-#   HANDLERS
-#
-####
+        self.misses += 1
 
+    def set(self, posts, version=None):
+        if version is not None and version != self.version:
+            return
 
-START_COMMAND = 'start'
-FUTURE_EVENTS_COMMAND = 'future_events'
-EVENTS_ARCHIVE_COMMAND = EVENTS_ARCHIVE
-LECTURES_ARCHIVE_COMMAND = LECTURES_ARCHIVE
-CHATS_COMMAND = CHATS
-CONTACTS_COMMAND = CONTACTS
-WHOIS_HOWTO_COMMAND = WHOIS_HOWTO
+        self.posts = posts
+        self.expires = monotonic() + self.ttl
 
-BOT_COMMANDS = [
-    BotCommand(FUTURE_EVENTS_COMMAND, 'ближайшие эвенты'),
-    BotCommand(EVENTS_ARCHIVE_COMMAND, 'архив эвентов'),
-    BotCommand(LECTURES_ARCHIVE_COMMAND, 'архив лекций'),
-    BotCommand(CHATS, 'тематические чаты'),
-    BotCommand(CONTACTS_COMMAND, 'контакты кураторов'),
-    BotCommand(WHOIS_HOWTO_COMMAND, 'мануал по #whois'),
-    BotCommand(START_COMMAND, 'интро'),
-]
+    def put(self, post):
+        self.version += 1
+        if self.posts is not None:
+            self.posts.put(post)
 
-START_TEXT = f'''Привет!
-Это бот-дворецкий ШАД. Я умею напоминать какие мероприятия \
-будут в скором времени, рассказывать про контакты кураторов, \
-показывать локальные чаты. В скором буду уметь еще много чего \
-интересного, но не все сразу :)
+    def delete(self, message_id):
+        self.version += 1
+        if self.posts is not None:
+            self.posts.delete(message_id)
 
-Если словил баг, то пиши моему разработчику @alexkuk
-Если есть идеи как меня развивать, то пиши @tinicheva
+    def clear(self):
+        self.posts = None
 
-Команды
-/{FUTURE_EVENTS_COMMAND} — ближайшие эвенты
-/{EVENTS_ARCHIVE_COMMAND} — архив эвентов
-/{LECTURES_ARCHIVE_COMMAND} — архив лекций
-/{CHATS_COMMAND} — тематические чаты
-/{CONTACTS_COMMAND} — контакты кураторов
-/{WHOIS_HOWTO_COMMAND} — мануал по #whois
 
-Команды доступны снизу по кнопке "Меню"'''
+######
+#   READ/WRITE
+######
 
-NO_FUTURE_EVENTS_TEXT = (
-    'В ближайшее время нет эвентов. '
-    f'Список прошедших — /{EVENTS_ARCHIVE_COMMAND}'
-)
 
-MISSING_POSTS_TEXT = 'Не нашел постов с тегом #{type}.'
-MISSING_FORWARD_TEXT = (
-    'Хотел переслать пост {url}, но он исчез. '
-    'Удалил из своей базы.'
-)
+POSTS_TABLE = 'posts'
+MESSAGE_ID_KEY = 'message_id'
 
 
-######
-#  START
-######
+async def scan_posts(db):
+    posts = []
+    async for item in dynamo_scan(
+            db.client, POSTS_TABLE,
+            segments=DYNAMO_SCAN_SEGMENTS
+    ):
+        posts.append(dynamo_parse_post(item))
+    return PostStore(posts)
 
 
-async def handle_start_command(context, message):
-    await message.answer(text=START_TEXT)
-    await context.bot.set_my_commands(
-        commands=BOT_COMMANDS
-    )
+async def load_posts(db):
+    version = db.cache.version
 
+    posts = None
+    if db.snapshot:
+        _, posts = await read_posts_snapshot(db)
+    if posts is None:
+        posts = await scan_posts(db)
 
-######
-#   OTHER
-#####
+    db.cache.set(posts, version)
+    return posts
 
 
-async def handle_other(context, message):
-    await message.answer(text=START_TEXT)
+async def read_posts(db):
+    posts = db.cache.get()
+    if posts is None:
+        posts = await db.flight.run(
+            POSTS_TABLE,
+            lambda: load_posts(db)
+        )
+    return posts
 
 
-######
-#   FORWARD
-####
+# Edits in chat are most frequent updates, most of them to untagged
+# messages. Warm cache answers hit and miss for free, otherwise single
+# GetItem. Post written by other container shows up after cache TTL,
+# same as for read_posts
 
 
-def message_url(chat_id, message_id):
-    # -1001627609834, 21 -> https://t.me/c/1627609834/21
-    # https://github.com/aiogram/aiogram/blob/master/aiogram/types/chat.py#L79
+async def get_post(db, message_id):
+    posts = db.cache.get()
+    if posts is not None:
+        return posts.get(message_id)
 
-    chat_id = -1_000_000_000_000 - chat_id
-    return f'https://t.me/c/{chat_id}/{message_id}'
+    item = await db.flight.run(
+        (POSTS_TABLE, message_id),
+        lambda: dynamo_get(
+            db.client, POSTS_TABLE,
+            MESSAGE_ID_KEY, N, message_id
+        )
+    )
+    if item:
+        return dynamo_parse_post(item)
 
 
-async def forward_post(context, message, post):
-    # Telegram Bot API missing delete event
-    # https://github.com/tdlib/telegram-bot-api/issues/286#issuecomment-1154020149
-    # Remove after forward fails. Rare in practice
+async def put_post(db, post):
+    item = dynamo_format_post(post)
+    await dynamo_put(db.client, POSTS_TABLE, item)
+    db.cache.put(post)
 
-    try:
-        await context.bot.forward_message(
-            chat_id=message.chat.id,
-            from_chat_id=CHAT_ID,
-            message_id=post.message_id
-        )
+    if db.snapshot:
+        await update_posts_snapshot(db, lambda _: _.put(post))
 
-    # No sure why 2 types of exceptions
-    # Clear history, empty chat -> MessageIdInvalid
-    # Remove single message -> MessageToForwardNotFound
-    except (MessageToForwardNotFound, MessageIdInvalid):
-        await context.db.delete_post(post.message_id)
 
-        url = message_url(
-            chat_id=CHAT_ID,
-            message_id=post.message_id
-        )
-        text = MISSING_FORWARD_TEXT.format(url=url)
-        await message.answer(text=text)
+async def delete_post(db, message_id):
+    await dynamo_delete(
+        db.client, POSTS_TABLE,
+        MESSAGE_ID_KEY, N, message_id
+    )
+    db.cache.delete(message_id)
 
+    if db.snapshot:
+        await update_posts_snapshot(db, lambda _: _.delete(message_id))
 
-######
-#   FUTURE EVENTS
-#######
 
+# Bulk backfill, cleanup. Batch must not repeat key
 
-def select_future(posts, cap=3):
-    today = Datetime.now().date()
-    posts = [
-        _ for _ in posts
-        if _.event_date >= today
+async def put_posts(db, posts, concurrency=1):
+    posts = {_.message_id: _ for _ in posts}
+    requests = [
+        {'PutRequest': {'Item': dynamo_format_post(_)}}
+        for _ in posts.values()
     ]
-    posts.sort(key=lambda _: _.event_date)
-    return posts[:cap]
+    await dynamo_batch_write(
+        db.client, POSTS_TABLE,
+        requests, concurrency
+    )
+    for post in posts.values():
+        db.cache.put(post)
 
+    def change(snapshot):
+        for post in posts.values():
+            snapshot.put(post)
 
-async def handle_future_events_command(context, message):
-    posts = await context.db.read_posts()
-    posts = list(find_posts(posts, type=EVENT))
-    if not posts:
-        text = MISSING_POSTS_TEXT.format(type=EVENT)
-        await message.answer(text=text)
-        return
+    if db.snapshot:
+        await update_posts_snapshot(db, change)
 
-    posts = select_future(posts)
-    if not posts:
-        await message.answer(text=NO_FUTURE_EVENTS_TEXT)
-        return
 
-    for post in posts:
-        await forward_post(context, message, post)
+async def delete_posts(db, message_ids, concurrency=1):
+    message_ids = set(message_ids)
+    requests = [
+        {'DeleteRequest': {'Key': {MESSAGE_ID_KEY: {N: str(_)}}}}
+        for _ in message_ids
+    ]
+    await dynamo_batch_write(
+        db.client, POSTS_TABLE,
+        requests, concurrency
+    )
+    for message_id in message_ids:
+        db.cache.delete(message_id)
 
+    def change(snapshot):
+        for message_id in message_ids:
+            snapshot.delete(message_id)
 
-#######
-#  NAV
-####
+    if db.snapshot:
+        await update_posts_snapshot(db, change)
 
 
-async def handle_nav_command(context, message, type):
-    posts = await context.db.read_posts()
-    post = find_post(posts, type=type)
-    if post:
-        await forward_post(context, message, post)
-    else:
-        text = MISSING_POSTS_TEXT.format(type=type)
-        await message.answer(text=text)
+######
+#   SNAPSHOT
+######
 
+# Whole posts table is few hundred tiny rows. Keep copy in single
+# compressed item, cold container loads it with one GetItem instead
+# of paginated scan. Posts table stays source of truth, writers
+# update snapshot after table with optimistic lock on version. If
+# lock fails too often or snapshot outgrows item limit, drop it,
+# readers fall back to scan. Only periodic job creates snapshot from
+# scan, fixes writers that crashed in between. Writers skip missing
+# snapshot, otherwise every write after drop pays full scan
 
-async def handle_chats_command(context, message):
-    await handle_nav_command(context, message, CHATS)
+POSTS_SNAPSHOT = bool(int(getenv('POSTS_SNAPSHOT', 0)))
+POSTS_SNAPSHOT_REBUILD_INTERVAL = 60 * 60
 
+SNAPSHOTS_TABLE = 'snapshots'
+SNAPSHOT_KEY = 'snapshot'
+POSTS_SNAPSHOT_NAME = 'posts'
+SNAPSHOT_RETRIES = 5
 
-async def handle_contacts_command(context, message):
-    await handle_nav_command(context, message, CONTACTS)
+# Dynamo item limit is 400KB
+SNAPSHOT_MAX_SIZE = 300 * 1024
 
 
-async def handle_whois_howto_command(context, message):
-    await handle_nav_command(context, message, WHOIS_HOWTO)
+# One line per post, zlib compressed
+# 5614 event 2022-07-09
+# 5638 contacts
 
 
-async def handle_events_archive_command(context, message):
-    await handle_nav_command(context, message, EVENTS_ARCHIVE)
+def format_posts_snapshot(posts):
+    lines = []
+    for post in posts:
+        line = f'{post.message_id} {post.type}'
+        if post.event_date:
+            line += f' {post.event_date.isoformat()}'
+        lines.append(line)
+    text = '\n'.join(lines)
+    return zlib.compress(text.encode('utf8'))
+
+
+def parse_posts_snapshot(data):
+    posts = []
+    text = zlib.decompress(data).decode('utf8')
+    for line in text.splitlines():
+        message_id, type, *event_date = line.split(' ')
+        if event_date:
+            event_date = Date.fromisoformat(event_date[0])
+        else:
+            event_date = None
+        posts.append(Post(int(message_id), type, event_date))
+    return PostStore(posts)
+
+
+async def read_posts_snapshot(db):
+    item = await dynamo_get(
+        db.client, SNAPSHOTS_TABLE,
+        SNAPSHOT_KEY, S, POSTS_SNAPSHOT_NAME
+    )
+    if not item:
+        return None, None
+
+    version = int(item['version'][N])
+    posts = parse_posts_snapshot(item['posts']['B'])
+    return version, posts
+
+
+async def write_posts_snapshot(db, posts, version):
+    data = format_posts_snapshot(posts)
+    if len(data) > SNAPSHOT_MAX_SIZE:
+        raise ValueError(f'Snapshot size {len(data)}')
+
+    item = {
+        SNAPSHOT_KEY: {S: POSTS_SNAPSHOT_NAME},
+        'version': {N: str((version or 0) + 1)},
+        'posts': {'B': data},
+    }
+    if version is None:
+        await dynamo_put(
+            db.client, SNAPSHOTS_TABLE, item,
+            condition=f'attribute_not_exists({SNAPSHOT_KEY})'
+        )
+    else:
+        await dynamo_put(
+            db.client, SNAPSHOTS_TABLE, item,
+            condition='#version = :version',
+            names={'#version': 'version'},
+            values={':version': {N: str(version)}}
+        )
+
+
+async def drop_posts_snapshot(db):
+    await dynamo_delete(
+        db.client, SNAPSHOTS_TABLE,
+        SNAPSHOT_KEY, S, POSTS_SNAPSHOT_NAME
+    )
+
+
+async def save_posts_snapshot(db, load):
+    for _ in range(SNAPSHOT_RETRIES):
+        version, posts = await load()
+        if posts is None:
+            return
+
+        try:
+            await write_posts_snapshot(db, posts, version)
+            return
+        except ClientError as error:
+            if not is_condition_failed(error):
+                raise
+        except ValueError as error:
+            log.warning(f'Drop posts snapshot: {error}')
+            break
+    else:
+        log.warning('Drop posts snapshot: too many conflicts')
+
+    await drop_posts_snapshot(db)
+
+
+async def update_posts_snapshot(db, change):
+    async def load():
+        version, posts = await read_posts_snapshot(db)
+        if posts is not None:
+            change(posts)
+        return version, posts
+
+    await save_posts_snapshot(db, load)
+
+
+async def rebuild_posts_snapshot(db):
+    created = False
+
+    async def load():
+        nonlocal created
+        version, _ = await read_posts_snapshot(db)
+        created = version is None
+        posts = await scan_posts(db)
+        return version, posts
+
+    await save_posts_snapshot(db, load)
+    if created:
+        # Writers skip missing snapshot, post written between scan and
+        # create is lost. Writers after create update snapshot, second
+        # scan catches ones in between
+        await save_posts_snapshot(db, load)
+
+
+######
+#   ARCHIVE
+######
+
+# Hot posts table grows by event every week. Move events past
+# event_date + grace to archived_events table, hot scan stays bounded.
+# Keep newest event hot, future events command tells "no future
+# events" from "no events at all". Write archive first, then delete
+# from hot, crash leaves duplicate not loss
+
+ARCHIVE_EVENTS = bool(int(getenv('ARCHIVE_EVENTS', 0)))
+ARCHIVE_EVENTS_GRACE = int(getenv('ARCHIVE_EVENTS_GRACE', 7))  # days
+ARCHIVE_EVENTS_INTERVAL = 24 * 60 * 60
+
+ARCHIVED_EVENTS_TABLE = 'archived_events'
+
+
+def select_archive_events(posts, today, grace=ARCHIVE_EVENTS_GRACE):
+    events = posts.select_events(Date.min)
+    stop = Date.fromordinal(today.toordinal() - grace)
+    return [
+        _ for _ in events[:-1]
+        if _.event_date < stop
+    ]
+
+
+async def archive_events(db, today=None, concurrency=1):
+    if not today:
+        today = Datetime.now().date()
+
+    posts = await read_posts(db)
+    events = select_archive_events(posts, today)
+    if not events:
+        return []
+
+    requests = [
+        {'PutRequest': {'Item': dynamo_format_post(_)}}
+        for _ in events
+    ]
+    await dynamo_batch_write(
+        db.client, ARCHIVED_EVENTS_TABLE,
+        requests, concurrency
+    )
+    await delete_posts(
+        db, [_.message_id for _ in events],
+        concurrency
+    )
+
+    log.info(f'Archived {len(events)} events')
+    return events
+
+
+async def read_archived_events(db):
+    posts = []
+    async for item in dynamo_scan(db.client, ARCHIVED_EVENTS_TABLE):
+        posts.append(dynamo_parse_post(item))
+
+    # Newest first, as select_posts
+    posts.sort(
+        key=lambda _: (_.event_date, _.message_id),
+        reverse=True
+    )
+    return posts
+
+
+######
+#   INDEXES
+######
+
+# Query one type instead of full table scan. Posts without
+# event_date are missing in sparse type_event_date index, so
+# type_message_id for nav posts. Create indexes with "python main.py
+# migrate", then set POSTS_INDEXES=1. Otherwise full scan fills cache
+
+POSTS_INDEXES = bool(int(getenv('POSTS_INDEXES', 0)))
+
+TYPE_EVENT_DATE_INDEX = 'type_event_date'
+TYPE_MESSAGE_ID_INDEX = 'type_message_id'
+
+POSTS_INDEX_KEYS = {
+    TYPE_EVENT_DATE_INDEX: ('event_date', S),
+    TYPE_MESSAGE_ID_INDEX: ('message_id', N),
+}
+
+
+async def read_posts_by_type(db, type, start=None, limit=None):
+    if not db.indexes:
+        posts = await read_posts(db)
+        return select_posts(posts, type, start, limit)
+
+    posts = db.cache.get()
+    if posts is not None:
+        return select_posts(posts, type, start, limit)
+
+    names = {'#type': 'type'}
+    values = {':type': {S: type}}
+    if type == EVENT and start:
+        index = TYPE_EVENT_DATE_INDEX
+        condition = '#type = :type AND event_date >= :start'
+        values[':start'] = {S: start.isoformat()}
+        forward = True
+    else:
+        index = TYPE_MESSAGE_ID_INDEX
+        condition = '#type = :type'
+        forward = False
+
+    async def query():
+        return [
+            dynamo_parse_post(_)
+            async for _ in dynamo_query(
+                    db.client, POSTS_TABLE, index,
+                    condition, names, values,
+                    forward=forward, limit=limit
+            )
+        ]
+
+    # Callers may mutate list
+    posts = await db.flight.run(
+        (POSTS_TABLE, type, start, limit),
+        query
+    )
+    return list(posts)
+
+
+# Dynamo builds one new GSI per table at a time, next Create fails
+# with LimitExceededException. Wait until index is ACTIVE
+
+POSTS_INDEX_POLL_INTERVAL = 10  # seconds
+ACTIVE = 'ACTIVE'
+
+
+async def wait_posts_index(db, index, interval=POSTS_INDEX_POLL_INTERVAL):
+    while True:
+        response = await db.client.describe_table(TableName=POSTS_TABLE)
+        statuses = {
+            _['IndexName']: _['IndexStatus']
+            for _ in response['Table'].get('GlobalSecondaryIndexes', [])
+        }
+        status = statuses.get(index)
+        if status == ACTIVE:
+            return
+
+        log.info(f'Index {index!r} status {status!r}, wait')
+        await asyncio.sleep(interval)
+
+
+async def create_posts_indexes(db, interval=POSTS_INDEX_POLL_INTERVAL):
+    response = await db.client.describe_table(TableName=POSTS_TABLE)
+    table = response['Table']
+    existing = [
+        _['IndexName']
+        for _ in table.get('GlobalSecondaryIndexes', [])
+    ]
+
+    for index, (key, key_type) in POSTS_INDEX_KEYS.items():
+        if index in existing:
+            # Previous migrate may have stopped while index was built
+            await wait_posts_index(db, index, interval)
+            continue
+
+        log.info(f'Create index {index!r}')
+        await db.client.update_table(
+            TableName=POSTS_TABLE,
+            AttributeDefinitions=[
+                {'AttributeName': 'type', 'AttributeType': S},
+                {'AttributeName': key, 'AttributeType': key_type},
+            ],
+            GlobalSecondaryIndexUpdates=[{
+                'Create': {
+                    'IndexName': index,
+                    'KeySchema': [
+                        {'AttributeName': 'type', 'KeyType': 'HASH'},
+                        {'AttributeName': key, 'KeyType': 'RANGE'},
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'},
+                }
+            }]
+        )
+        await wait_posts_index(db, index, interval)
+
+
+######
+#   MEMBERS
+######
+
+# Membership index, bot receives chat_member updates for CHAT_ID and
+# writes statuses here. Survives container restarts. Create table,
+# then set MEMBERS_INDEX=1
+
+MEMBERS_INDEX = bool(int(getenv('MEMBERS_INDEX', 0)))
+
+MEMBERS_TABLE = 'members'
+USER_ID_KEY = 'user_id'
+
+
+async def get_member(db, user_id):
+    item = await dynamo_get(
+        db.client, MEMBERS_TABLE,
+        USER_ID_KEY, N, user_id
+    )
+    if item:
+        return item['status']['S']
+
+
+async def put_member(db, user_id, status):
+    item = {
+        USER_ID_KEY: {N: str(user_id)},
+        'status': {S: status},
+    }
+    await dynamo_put(db.client, MEMBERS_TABLE, item)
+
+
+######
+#   UPDATES
+######
+
+# Seen update ids, shared by container instances. Set Dynamo TTL on
+# "expires" to clean up
+
+UPDATES_TABLE = 'updates'
+UPDATE_ID_KEY = 'update_id'
+UPDATE_TTL = 24 * 60 * 60
+
+
+async def put_update(db, update_id):
+    item = {
+        UPDATE_ID_KEY: {N: str(update_id)},
+        'expires': {N: str(int(Datetime.now().timestamp()) + UPDATE_TTL)},
+    }
+    try:
+        await dynamo_put(
+            db.client, UPDATES_TABLE, item,
+            condition=f'attribute_not_exists({UPDATE_ID_KEY})'
+        )
+    except ClientError as error:
+        if is_condition_failed(error):
+            return False
+        raise
+    return True
+
+
+async def delete_update(db, update_id):
+    await dynamo_delete(
+        db.client, UPDATES_TABLE,
+        UPDATE_ID_KEY, N, update_id
+    )
+
+
+######
+#  DB
+#######
+
+
+class DB:
+    def __init__(self):
+        self.exit_stack = None
+        self.client = None
+        self.cache = PostsCache()
+        self.flight = SingleFlight()
+        self.indexes = POSTS_INDEXES
+        self.snapshot = POSTS_SNAPSHOT
+        self.members_index = MEMBERS_INDEX
+
+    async def connect(self):
+        self.exit_stack, self.client = await dynamo_client()
+
+    async def close(self):
+        await self.exit_stack.aclose()
+
+
+DB.read_posts = read_posts
+DB.get_post = get_post
+DB.put_post = put_post
+DB.delete_post = delete_post
+DB.put_posts = put_posts
+DB.delete_posts = delete_posts
+DB.read_posts_by_type = read_posts_by_type
+DB.create_posts_indexes = create_posts_indexes
+DB.rebuild_posts_snapshot = rebuild_posts_snapshot
+DB.archive_events = archive_events
+DB.read_archived_events = read_archived_events
+DB.get_member = get_member
+DB.put_member = put_member
+DB.put_update = put_update
+DB.delete_update = delete_update
+
+
+#######
+#
+#   BACKENDS
+#
+#####
+
+# DB above is Dynamo backend. Others have same duck typed interface,
+# pick with DB_BACKEND. Run bot, tests, benchmarks without network
+#
+#   connect, close
+#   read_posts, get_post, read_posts_by_type
+#   put_post, delete_post, put_posts, delete_posts
+#   archive_events, read_archived_events
+#   get_member, put_member, put_update, delete_update
+#
+# Plus "indexes", "snapshot" flags. Dynamo only: create_posts_indexes,
+# rebuild_posts_snapshot
+
+DYNAMO_BACKEND = 'dynamo'
+MEMORY_BACKEND = 'memory'
+SQLITE_BACKEND = 'sqlite'
+
+DB_BACKEND = getenv('DB_BACKEND', DYNAMO_BACKEND)
+
+
+######
+#   MEMORY
+#####
+
+# Lost on restart. Tests, load tests, benchmarks
+
+
+class MemoryDB:
+    def __init__(self):
+        self.posts = PostStore()
+        self.archived_events = PostStore()
+        self.members = {}
+
+        # update_id -> expires. Same TTL for all, so insertion order
+        # is expiration order
+        self.updates = {}
+
+        self.indexes = False
+        self.snapshot = False
+        self.members_index = True
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def read_posts(self):
+        return self.posts
+
+    async def get_post(self, message_id):
+        return self.posts.get(message_id)
+
+    async def read_posts_by_type(self, type, start=None, limit=None):
+        return select_posts(self.posts, type, start, limit)
+
+    async def put_post(self, post):
+        self.posts.put(post)
+
+    async def delete_post(self, message_id):
+        self.posts.delete(message_id)
+
+    async def put_posts(self, posts, concurrency=1):
+        for post in posts:
+            self.posts.put(post)
+
+    async def delete_posts(self, message_ids, concurrency=1):
+        for message_id in message_ids:
+            self.posts.delete(message_id)
+
+    async def archive_events(self, today=None, concurrency=1):
+        if not today:
+            today = Datetime.now().date()
+
+        events = select_archive_events(self.posts, today)
+        for post in events:
+            self.archived_events.put(post)
+            self.posts.delete(post.message_id)
+        return events
+
+    async def read_archived_events(self):
+        posts = self.archived_events.select_events(Date.min)
+        posts.reverse()
+        return posts
+
+    async def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def put_member(self, user_id, status):
+        self.members[user_id] = status
+
+    async def put_update(self, update_id):
+        now = monotonic()
+        while self.updates:
+            oldest = next(iter(self.updates))
+            if self.updates[oldest] > now:
+                break
+            del self.updates[oldest]
+
+        if update_id in self.updates:
+            return False
+        self.updates[update_id] = now + UPDATE_TTL
+        return True
+
+    async def delete_update(self, update_id):
+        self.updates.pop(update_id, None)
+
+
+######
+#   SQLITE
+#####
+
+# Single container or local run. aiosqlite is optional, imported on
+# connect. Indexes mirror Dynamo GSIs: events by date, other types by
+# message_id
+
+SQLITE_PATH = getenv('SQLITE_PATH', 'shad-butler.sqlite')
+
+SQLITE_SCHEMA = '''
+create table if not exists posts (
+    message_id integer primary key,
+    type text not null,
+    event_date text
+);
+create index if not exists posts_type_event_date
+    on posts (type, event_date, message_id);
+create index if not exists posts_type_message_id
+    on posts (type, message_id);
+
+create table if not exists archived_events (
+    message_id integer primary key,
+    type text not null,
+    event_date text
+);
+
+create table if not exists members (
+    user_id integer primary key,
+    status text not null
+);
+
+create table if not exists updates (
+    update_id integer primary key,
+    expires integer not null
+);
+create index if not exists updates_expires
+    on updates (expires);
+'''
+
+SQLITE_POST_COLUMNS = 'message_id, type, event_date'
+
+
+def sqlite_format_post(post):
+    event_date = None
+    if post.event_date:
+        event_date = post.event_date.isoformat()
+    return post.message_id, post.type, event_date
+
+
+def sqlite_parse_post(row):
+    message_id, type, event_date = row
+    if event_date:
+        event_date = Date.fromisoformat(event_date)
+    return Post(message_id, type, event_date)
+
+
+class SqliteDB:
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.conn = None
+
+        self.indexes = True
+        self.snapshot = False
+        self.members_index = True
+
+    async def connect(self):
+        import aiosqlite
+
+        self.conn = await aiosqlite.connect(self.path)
+        await self.conn.executescript(SQLITE_SCHEMA)
+        await self.conn.commit()
+
+    async def close(self):
+        await self.conn.close()
+
+    async def select_posts(self, where='', params=(), table='posts'):
+        rows = await self.conn.execute_fetchall(
+            f'select {SQLITE_POST_COLUMNS} from {table} {where}',
+            params
+        )
+        return [sqlite_parse_post(_) for _ in rows]
+
+    async def read_posts(self):
+        return post_store(await self.select_posts())
+
+    async def get_post(self, message_id):
+        posts = await self.select_posts(
+            'where message_id = ?',
+            (message_id,)
+        )
+        if posts:
+            return posts[0]
+
+    async def read_posts_by_type(self, type, start=None, limit=None):
+        # Same order as select_posts. Limit -1 is no limit
+        if limit is None:
+            limit = -1
+
+        if type == EVENT and start:
+            return await self.select_posts(
+                'where type = ? and event_date >= ? '
+                'order by event_date, message_id limit ?',
+                (type, start.isoformat(), limit)
+            )
+
+        return await self.select_posts(
+            'where type = ? order by message_id desc limit ?',
+            (type, limit)
+        )
+
+    async def put_posts(self, posts, concurrency=1, table='posts'):
+        await self.conn.executemany(
+            f'insert or replace into {table} ({SQLITE_POST_COLUMNS}) '
+            'values (?, ?, ?)',
+            [sqlite_format_post(_) for _ in posts]
+        )
+        await self.conn.commit()
+
+    async def delete_posts(self, message_ids, concurrency=1):
+        await self.conn.executemany(
+            'delete from posts where message_id = ?',
+            [(_,) for _ in message_ids]
+        )
+        await self.conn.commit()
+
+    async def put_post(self, post):
+        await self.put_posts([post])
+
+    async def delete_post(self, message_id):
+        await self.delete_posts([message_id])
+
+    async def archive_events(self, today=None, concurrency=1):
+        if not today:
+            today = Datetime.now().date()
+
+        posts = await self.read_posts()
+        events = select_archive_events(posts, today)
+        if events:
+            await self.put_posts(events, table='archived_events')
+            await self.delete_posts([_.message_id for _ in events])
+        return events
+
+    async def read_archived_events(self):
+        return await self.select_posts(
+            'order by event_date desc, message_id desc',
+            table='archived_events'
+        )
+
+    async def get_member(self, user_id):
+        rows = await self.conn.execute_fetchall(
+            'select status from members where user_id = ?',
+            (user_id,)
+        )
+        if rows:
+            status, = rows[0]
+            return status
+
+    async def put_member(self, user_id, status):
+        await self.conn.execute(
+            'insert or replace into members (user_id, status) '
+            'values (?, ?)',
+            (user_id, status)
+        )
+        await self.conn.commit()
+
+    async def put_update(self, update_id):
+        now = int(Datetime.now().timestamp())
+        await self.conn.execute(
+            'delete from updates where expires <= ?',
+            (now,)
+        )
+        cursor = await self.conn.execute(
+            'insert or ignore into updates (update_id, expires) '
+            'values (?, ?)',
+            (update_id, now + UPDATE_TTL)
+        )
+        await self.conn.commit()
+        return cursor.rowcount == 1
+
+    async def delete_update(self, update_id):
+        await self.conn.execute(
+            'delete from updates where update_id = ?',
+            (update_id,)
+        )
+        await self.conn.commit()
+
+
+######
+#   FAULTS
+#####
+
+# Wrap any backend, add latency and errors to every call. Load test
+# handlers with storage that behaves like network: exponential
+# latency with DB_LATENCY mean seconds, DB_ERRORS fraction of calls
+# fail with ClientError as throttled Dynamo
+
+DB_LATENCY = float(getenv('DB_LATENCY', 0))
+DB_ERRORS = float(getenv('DB_ERRORS', 0))
+
+
+class FaultyDB:
+    def __init__(self, db, latency=DB_LATENCY, errors=DB_ERRORS, seed=None):
+        self.db = db
+        self.latency = latency
+        self.errors = errors
+        self.random = Random(seed)
+
+        self.calls = 0
+        self.failures = 0
+
+    def __getattr__(self, name):
+        value = getattr(self.db, name)
+        if (
+                name in ('connect', 'close')
+                or not asyncio.iscoroutinefunction(value)
+        ):
+            return value
+
+        async def call(*args, **kwargs):
+            self.calls += 1
+            if self.latency:
+                await asyncio.sleep(
+                    self.random.expovariate(1 / self.latency)
+                )
+            if self.random.random() < self.errors:
+                self.failures += 1
+                code = 'ProvisionedThroughputExceededException'
+                raise ClientError({'Error': {'Code': code}}, name)
+            return await value(*args, **kwargs)
+
+        return call
+
+
+def make_db(backend=DB_BACKEND):
+    db = {
+        DYNAMO_BACKEND: DB,
+        MEMORY_BACKEND: MemoryDB,
+        SQLITE_BACKEND: SqliteDB,
+    }[backend]()
+    if DB_LATENCY or DB_ERRORS:
+        db = FaultyDB(db)
+    return db
+
+
+#######
+#
+#   SENDER
+#
+####
+
+# Telegram flood limits, about 30 messages per second overall, about
+# 1 per second per chat, short bursts are ok
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+
+
+######
+#   TOKEN BUCKET
+#####
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    # Reserve token, return delay until it is available. Negative
+    # tokens keep callers in FIFO order
+
+    def take(self):
+        now = monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.take()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+######
+#   SENDER
+####
+
+# Requests to different chats go concurrently. Requests to one chat
+# go one by one in order of send, Telegram shows messages in order
+# of arrival
+
+SEND_RATE = float(getenv('SEND_RATE', 30))
+CHAT_SEND_RATE = float(getenv('CHAT_SEND_RATE', 1))
+CHAT_SEND_BURST = int(getenv('CHAT_SEND_BURST', 5))
+SEND_RETRIES = 3
+SEND_BACKOFF = 1
+SEND_CHATS = 10000
+
+
+class Sender:
+    def __init__(
+            self,
+            rate=SEND_RATE,
+            chat_rate=CHAT_SEND_RATE,
+            chat_burst=CHAT_SEND_BURST,
+            retries=SEND_RETRIES,
+            backoff=SEND_BACKOFF,
+            chats=SEND_CHATS
+    ):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.backoff = backoff
+        self.chats = chats
+
+        # chat_id -> bucket, LRU order
+        self.chat_buckets = OrderedDict()
+
+        # chat_id -> last task in chat queue
+        self.lanes = {}
+        self.depths = {}
+
+        self.pending = 0
+        self.max_pending = 0
+        self.retried = 0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket:
+            self.chat_buckets.move_to_end(chat_id)
+        else:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > self.chats:
+                self.chat_buckets.popitem(last=False)
+        return bucket
+
+    def send(self, chat_id, request):
+        previous = self.lanes.get(chat_id)
+        task = asyncio.ensure_future(
+            self.run(chat_id, request, previous)
+        )
+        self.lanes[chat_id] = task
+
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        self.depths[chat_id] = self.depths.get(chat_id, 0) + 1
+
+        def done(_):
+            self.pending -= 1
+            self.depths[chat_id] -= 1
+            if not self.depths[chat_id]:
+                del self.depths[chat_id]
+                del self.lanes[chat_id]
+
+        task.add_done_callback(done)
+        return task
+
+    async def run(self, chat_id, request, previous):
+        if previous:
+            # Wait, do not raise previous error
+            await asyncio.wait([previous])
+
+        await self.chat_bucket(chat_id).acquire()
+        await self.bucket.acquire()
+
+        for attempt in range(self.retries + 1):
+            try:
+                return await request()
+            except RetryAfter as error:
+                if attempt == self.retries:
+                    raise
+
+                self.retried += 1
+                delay = max(error.timeout, self.backoff * 2 ** attempt)
+                log.warning(f'Flood limit, retry after {delay}s')
+                await asyncio.sleep(delay)
+
+
+#######
+#
+#   HANDLERS
+#
+####
+
+
+START_COMMAND = 'start'
+FUTURE_EVENTS_COMMAND = 'future_events'
+EVENTS_ARCHIVE_COMMAND = EVENTS_ARCHIVE
+LECTURES_ARCHIVE_COMMAND = LECTURES_ARCHIVE
+CHATS_COMMAND = CHATS
+CONTACTS_COMMAND = CONTACTS
+WHOIS_HOWTO_COMMAND = WHOIS_HOWTO
+
+BOT_COMMANDS = [
+    BotCommand(FUTURE_EVENTS_COMMAND, 'ближайшие эвенты'),
+    BotCommand(EVENTS_ARCHIVE_COMMAND, 'архив эвентов'),
+    BotCommand(LECTURES_ARCHIVE_COMMAND, 'архив лекций'),
+    BotCommand(CHATS, 'тематические чаты'),
+    BotCommand(CONTACTS_COMMAND, 'контакты кураторов'),
+    BotCommand(WHOIS_HOWTO_COMMAND, 'мануал по #whois'),
+    BotCommand(START_COMMAND, 'интро'),
+]
+
+START_TEXT = f'''Привет!
+Это бот-дворецкий ШАД. Я умею напоминать какие мероприятия \
+будут в скором времени, рассказывать про контакты кураторов, \
+показывать локальные чаты. В скором буду уметь еще много чего \
+интересного, но не все сразу :)
+
+Если словил баг, то пиши моему разработчику @alexkuk
+Если есть идеи как меня развивать, то пиши @tinicheva
+
+Команды
+/{FUTURE_EVENTS_COMMAND} — ближайшие эвенты
+/{EVENTS_ARCHIVE_COMMAND} — архив эвентов
+/{LECTURES_ARCHIVE_COMMAND} — архив лекций
+/{CHATS_COMMAND} — тематические чаты
+/{CONTACTS_COMMAND} — контакты кураторов
+/{WHOIS_HOWTO_COMMAND} — мануал по #whois
+
+Команды доступны снизу по кнопке "Меню"'''
+
+NO_FUTURE_EVENTS_TEXT = (
+    'В ближайшее время нет эвентов. '
+    f'Список прошедших — /{EVENTS_ARCHIVE_COMMAND}'
+)
+
+MISSING_POSTS_TEXT = 'Не нашел постов с тегом #{type}.'
+MISSING_FORWARD_TEXT = (
+    'Хотел переслать пост {url}, но он исчез. '
+    'Удалил из своей базы.'
+)
+
+
+######
+#   ANSWER
+######
+
+# Telegram waits for webhook response anyway. Handler may return
+# method call as response, saves outbound request. Only for single
+# answer at the end of handler, errors in response are not reported
+# https://core.telegram.org/bots/api#making-requests-when-getting-updates
+
+WEBHOOK_REPLY = bool(int(getenv('WEBHOOK_REPLY', 1)))
+
+
+async def answer(context, message, text, reply=False):
+    if reply and context.webhook_reply:
+        return SendMessage(message.chat.id, text)
+
+    await context.sender.send(
+        message.chat.id,
+        lambda: message.answer(text=text)
+    )
+
+
+######
+#  START
+######
+
+
+async def setup_commands(context):
+    await context.bot.set_my_commands(
+        commands=BOT_COMMANDS
+    )
+
+
+# Cold container answers first update after on_startup. Commands are
+# not needed to answer, do not wait Telegram round trip, do not fail
+# startup if Telegram is down
+
+
+async def setup_commands_background(context):
+    try:
+        await context.setup_commands()
+    except Exception:
+        log.exception('Failed set commands')
+
+
+async def handle_start_command(context, message):
+    return await answer(context, message, START_TEXT, reply=True)
+
+
+######
+#   OTHER
+#####
+
+
+async def handle_other(context, message):
+    return await answer(context, message, START_TEXT, reply=True)
+
+
+######
+#   FORWARD
+####
+
+
+def message_url(chat_id, message_id):
+    # -1001627609834, 21 -> https://t.me/c/1627609834/21
+    # https://github.com/aiogram/aiogram/blob/master/aiogram/types/chat.py#L79
+
+    chat_id = -1_000_000_000_000 - chat_id
+    return f'https://t.me/c/{chat_id}/{message_id}'
+
+
+async def forward_post(context, message, post):
+    # Telegram Bot API missing delete event
+    # https://github.com/tdlib/telegram-bot-api/issues/286#issuecomment-1154020149
+    # Remove after forward fails. Rare in practice
+
+    try:
+        await context.sender.send(
+            message.chat.id,
+            lambda: context.bot.forward_message(
+                chat_id=message.chat.id,
+                from_chat_id=CHAT_ID,
+                message_id=post.message_id
+            )
+        )
+
+    # No sure why 2 types of exceptions
+    # Clear history, empty chat -> MessageIdInvalid
+    # Remove single message -> MessageToForwardNotFound
+    except (MessageToForwardNotFound, MessageIdInvalid):
+        await context.db.delete_post(post.message_id)
+
+        url = message_url(
+            chat_id=CHAT_ID,
+            message_id=post.message_id
+        )
+        text = MISSING_FORWARD_TEXT.format(url=url)
+        await answer(context, message, text)
+
+
+######
+#   FUTURE EVENTS
+#######
+
+
+FUTURE_EVENTS_CAP = 3
+
+
+async def handle_future_events_command(context, message):
+    today = Datetime.now().date()
+    posts = await context.db.read_posts_by_type(
+        EVENT, start=today,
+        limit=FUTURE_EVENTS_CAP
+    )
+    if not posts:
+        text = NO_FUTURE_EVENTS_TEXT
+        if not await context.db.read_posts_by_type(EVENT, limit=1):
+            text = MISSING_POSTS_TEXT.format(type=EVENT)
+        return await answer(context, message, text, reply=True)
+
+    # Sender keeps order
+    await asyncio.gather(*[
+        forward_post(context, message, post)
+        for post in posts
+    ])
+
+
+#######
+#  NAV
+####
+
+
+async def handle_nav_command(context, message, type):
+    posts = await context.db.read_posts_by_type(type, limit=1)
+    if posts:
+        await forward_post(context, message, posts[0])
+    else:
+        text = MISSING_POSTS_TEXT.format(type=type)
+        return await answer(context, message, text, reply=True)
+
+
+async def handle_chats_command(context, message):
+    return await handle_nav_command(context, message, CHATS)
+
+
+async def handle_contacts_command(context, message):
+    return await handle_nav_command(context, message, CONTACTS)
+
+
+async def handle_whois_howto_command(context, message):
+    return await handle_nav_command(context, message, WHOIS_HOWTO)
+
+
+async def handle_events_archive_command(context, message):
+    return await handle_nav_command(context, message, EVENTS_ARCHIVE)
 
 
 async def handle_lectures_archive_command(context, message):
-    await handle_nav_command(context, message, LECTURES_ARCHIVE)
+    return await handle_nav_command(context, message, LECTURES_ARCHIVE)
 
 
 ####
@@ -492,32 +2071,127 @@ async def handle_lectures_archive_command(context, message):
 #####
 
 
-async def new_post(context, message, footer):
-    post = Post(
-        message.message_id, footer.type,
-        footer.event_date
-    )
-    await context.db.put_post(post)
+async def write_post_footer(context, message_id, footer):
+    if footer:
+        # New post or added footer to existing message
+        post = Post(message_id, footer.type, footer.event_date)
+        await context.db.put_post(post)
+        return
+
+    post = await context.db.get_post(message_id)
+    if post:
+        # Removed footer from post
+        await context.db.delete_post(post.message_id)
+
+
+# Authors edit announcement several times in a row. Keep only last
+# footer per message, write once after quiet window. Same YC nuance
+# as UPDATE_WORKERS, window=0 writes at once
+
+CHAT_WRITE_WINDOW = float(getenv('CHAT_WRITE_WINDOW', 0))
+
+
+class ChatWrites:
+    def __init__(self, context, window=CHAT_WRITE_WINDOW):
+        self.context = context
+        self.window = window
+
+        # message_id -> footer, None if removed
+        self.pending = {}
+        self.timers = {}
+
+        # message_id -> last write task. Next write waits for it,
+        # otherwise slow put may land after later delete
+        self.writes = {}
+
+        self.submitted = 0
+        self.written = 0
+
+    async def submit(self, message_id, footer):
+        self.submitted += 1
+        if not self.window:
+            # Error goes to webhook, Telegram redelivers update
+            await write_post_footer(self.context, message_id, footer)
+            self.written += 1
+            return
+
+        self.pending[message_id] = footer
+        timer = self.timers.pop(message_id, None)
+        if timer:
+            timer.cancel()
+
+        loop = asyncio.get_running_loop()
+        self.timers[message_id] = loop.call_later(
+            self.window,
+            self.flush, message_id
+        )
+
+    def flush(self, message_id):
+        del self.timers[message_id]
+        footer = self.pending.pop(message_id)
+        previous = self.writes.get(message_id)
+        task = asyncio.ensure_future(
+            self.write(message_id, footer, previous)
+        )
+        self.writes[message_id] = task
+        task.add_done_callback(lambda _: self.done(message_id, task))
+
+    def done(self, message_id, task):
+        if self.writes.get(message_id) is task:
+            del self.writes[message_id]
+
+    async def write(self, message_id, footer, previous=None):
+        if previous:
+            await asyncio.wait([previous])
+
+        # Timer task, nobody to raise to
+        try:
+            await write_post_footer(self.context, message_id, footer)
+        except Exception:
+            log.exception(f'Failed write message id: {message_id}')
+        self.written += 1
+
+    async def close(self):
+        for message_id, timer in list(self.timers.items()):
+            timer.cancel()
+            self.flush(message_id)
+        await asyncio.gather(*self.writes.values())
 
 
 async def handle_chat_new_message(context, message):
     footer = parse_post_footer(message.text)
     if footer:
-        await new_post(context, message, footer)
+        await context.chat_writes.submit(message.message_id, footer)
 
 
 async def handle_chat_edited_message(context, message):
     footer = parse_post_footer(message.text)
-    if footer:
-        # Added footer to existing message
-        await new_post(context, message, footer)
-        return
+    await context.chat_writes.submit(message.message_id, footer)
 
-    posts = await context.db.read_posts()
-    post = find_post(posts, message_id=message.message_id)
-    if post:
-        # Removed footer from post
-        await context.db.delete_post(post.message_id)
+
+######
+#   MEMBERS
+#####
+
+# Telegram sends chat_member updates only to chat admins, only if
+# "chat_member" is in allowed_updates of webhook
+
+
+async def handle_chat_member(context, update):
+    member = update.new_chat_member
+    if context.db.members_index:
+        await context.db.put_member(member.user.id, member.status)
+    context.members.set(
+        member.user.id,
+        is_member_status(member.status)
+    )
+
+
+async def handle_my_chat_member(context, update):
+    # Without admin rights no chat_member updates, index goes stale
+    status = update.new_chat_member.status
+    if status != ChatMemberStatus.ADMINISTRATOR:
+        log.warning(f'Bot status in chat: {status!r}')
 
 
 #####
@@ -563,26 +2237,122 @@ def setup_handlers(context):
         commands=LECTURES_ARCHIVE_COMMAND,
     )
 
-    context.dispatcher.register_message_handler(
-        context.handle_other,
-        chat_type=ChatType.PRIVATE,
-    )
+    context.dispatcher.register_message_handler(
+        context.handle_other,
+        chat_type=ChatType.PRIVATE,
+    )
+
+    context.dispatcher.register_message_handler(
+        context.handle_chat_new_message,
+        chat_id=CHAT_ID,
+    )
+    context.dispatcher.register_edited_message_handler(
+        context.handle_chat_edited_message,
+        chat_id=CHAT_ID,
+    )
+
+    context.dispatcher.register_chat_member_handler(
+        context.handle_chat_member,
+        chat_id=CHAT_ID,
+    )
+    context.dispatcher.register_my_chat_member_handler(
+        context.handle_my_chat_member,
+        chat_id=CHAT_ID,
+    )
+
+
+######
+#
+#   MIDDLEWARE
+#
+######
+
+
+#######
+#  DEDUP
+######
+
+# Slow webhook -> Telegram redelivers same update. Drop repeats by
+# update_id before any work. Window is per container, DEDUP_TABLE=1
+# shares seen ids across container instances
+
+DEDUP_WINDOW = int(getenv('DEDUP_WINDOW', 1000))
+DEDUP_TABLE = bool(int(getenv('DEDUP_TABLE', 0)))
+
+
+class UpdateWindow:
+    def __init__(self, size=DEDUP_WINDOW):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, update_id):
+        if update_id in self.ids:
+            return False
+
+        self.ids.add(update_id)
+        self.order.append(update_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+    def discard(self, update_id):
+        if update_id in self.ids:
+            self.ids.remove(update_id)
+            self.order.remove(update_id)
+
+
+class TimedMiddleware(BaseMiddleware):
+    async def trigger(self, action, args):
+        # Called for every action, time only ones middleware has
+        if not hasattr(self, f'on_{action}'):
+            return
+
+        name = self.__class__.__name__
+        with Timer(MIDDLEWARE_SECONDS, name, action):
+            return await BaseMiddleware.trigger(self, action, args)
+
 
-    context.dispatcher.register_message_handler(
-        context.handle_chat_new_message,
-        chat_id=CHAT_ID,
-    )
-    context.dispatcher.register_edited_message_handler(
-        context.handle_chat_edited_message,
-        chat_id=CHAT_ID,
-    )
+class DedupMiddleware(TimedMiddleware):
+    def __init__(self, context, shared=DEDUP_TABLE):
+        self.context = context
+        self.shared = shared
+        self.window = UpdateWindow()
+        self.duplicates = 0
+        BaseMiddleware.__init__(self)
 
+    async def is_new(self, update_id):
+        if not self.window.add(update_id):
+            return False
 
-######
-#
-#   MIDDLEWARE
-#
-######
+        if self.shared:
+            try:
+                return await self.context.db.put_update(update_id)
+            except Exception:
+                self.window.discard(update_id)
+                raise
+
+        return True
+
+    async def on_pre_process_update(self, update, data):
+        if not await self.is_new(update.update_id):
+            self.duplicates += 1
+            log.info(f'Duplicate update id: {update.update_id}')
+            raise CancelHandler
+
+    # Processing raised. Webhook answers 500, Telegram redelivers, let
+    # redelivery through
+
+    async def on_pre_process_error(self, update, error, data):
+        self.window.discard(update.update_id)
+        if self.shared:
+            try:
+                await self.context.db.delete_update(update.update_id)
+            except Exception:
+                log.exception(f'Failed unmark update id: {update.update_id}')
 
 
 #######
@@ -594,12 +2364,174 @@ def setup_handlers(context):
 # YC Logging keeps only last 3 days of logs
 
 
-class LoggingMiddleware(BaseMiddleware):
+class LoggingMiddleware(TimedMiddleware):
     async def on_pre_process_message(self, message, data):
         if message.chat.type == ChatType.PRIVATE:
             log.info(f'From id: {message.from_id} text: {message.text!r}')
 
 
+#######
+#  PROFILE
+######
+
+# Background thread samples event loop thread stack every few ms,
+# keeps last samples with timestamps. Update done: pick samples
+# between start and end, count functions. Asyncio runs other updates
+# concurrently, their frames get into window too, summary shows
+# where loop thread was busy while update was in flight. Time in
+# select is idle, waiting for Dynamo, Telegram, see /metrics
+# histograms for that. No cProfile:
+# single profiler per thread, does not map to concurrent updates
+#
+# Summary has function names, update_id and type, never message
+# text, same as LoggingMiddleware
+
+
+PROFILE_INTERVAL = 0.005
+PROFILE_SAMPLES = 10000
+PROFILE_DEPTH = 64
+
+UPDATE_TYPES = [
+    'message',
+    'edited_message',
+    'chat_member',
+    'my_chat_member',
+]
+
+
+def update_type(update):
+    for type in UPDATE_TYPES:
+        if getattr(update, type, None):
+            return type
+    return 'other'
+
+
+def format_code(code):
+    return f'{basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}'
+
+
+def is_idle(code):
+    # Event loop in selector.select, waiting for IO
+    return code.co_name == 'select' and code.co_filename.endswith(
+        'selectors.py'
+    )
+
+
+class Profiler:
+    def __init__(self, rate=PROFILE_RATE, slow=PROFILE_SLOW,
+                 top=PROFILE_TOP, interval=PROFILE_INTERVAL):
+        self.rate = rate
+        self.slow = slow
+        self.top = top
+        self.interval = interval
+        self.enabled = bool(rate or slow)
+
+        # (time, innermost first code objects)
+        self.samples = deque(maxlen=PROFILE_SAMPLES)
+        self.thread = None
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.random = Random()
+
+        self.reported = 0
+
+    def start(self):
+        if not self.enabled:
+            return
+
+        # Called on loop thread
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame and len(stack) < PROFILE_DEPTH:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            self.samples.append((monotonic(), tuple(stack)))
+
+    def close(self):
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+
+    def should_report(self, duration):
+        return (
+            (self.slow and duration >= self.slow)
+            or (self.rate and self.random.random() < self.rate)
+        )
+
+    def summary(self, start, stop):
+        # list(deque) is atomic under GIL, sampler appends concurrently
+        samples = list(self.samples)
+        lo = bisect_left(samples, (start,))
+        hi = bisect_left(samples, (stop,))
+        samples = samples[lo:hi]
+
+        own = {}
+        total = {}
+        idle = 0
+        for _, stack in samples:
+            if not stack:
+                continue
+            if is_idle(stack[0]):
+                # Loop waits on network, nothing to profile
+                idle += 1
+                continue
+            own[stack[0]] = own.get(stack[0], 0) + 1
+            for code in set(stack):
+                total[code] = total.get(code, 0) + 1
+
+        top = sorted(own, key=own.get, reverse=True)[:self.top]
+        return len(samples), idle, [
+            (format_code(_), own[_], total[_])
+            for _ in top
+        ]
+
+    def report(self, update, start, stop):
+        duration = stop - start
+        if not self.should_report(duration):
+            return
+
+        self.reported += 1
+        count, idle, top = self.summary(start, stop)
+        lines = [
+            f'Profile update_id: {update.update_id} '
+            f'type: {update_type(update)} '
+            f'duration: {duration:.3f}s samples: {count} '
+            f'idle: {idle / max(count, 1):.0%}'
+        ]
+        for name, own, total in top:
+            lines.append(
+                f'  {own / count:4.0%} own {total / count:4.0%} total {name}'
+            )
+        log.warning('\n'.join(lines))
+
+
+PROFILE_START_KEY = 'profile_start'
+
+
+# First in chain, time whole update. Duplicate cancelled by
+# DedupMiddleware in pre process skips post process, not profiled
+
+
+class ProfileMiddleware(BaseMiddleware):
+    def __init__(self, context):
+        self.context = context
+        BaseMiddleware.__init__(self)
+
+    async def on_pre_process_update(self, update, data):
+        data[PROFILE_START_KEY] = monotonic()
+
+    async def on_post_process_update(self, update, results, data):
+        start = data.get(PROFILE_START_KEY)
+        if start:
+            self.context.profiler.report(update, start, monotonic())
+
+
 #######
 #  CHAT MEMBER
 ######
@@ -616,6 +2548,10 @@ class UserNotFound(BadRequest):
     match = 'user not found'
 
 
+def is_member_status(status):
+    return status not in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED)
+
+
 async def is_chat_member(bot, chat_id, user_id):
     try:
         member = await bot.get_chat_member(
@@ -625,13 +2561,85 @@ async def is_chat_member(bot, chat_id, user_id):
     except UserNotFound:
         return False
 
-    if member.status in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED):
-        return False
+    return is_member_status(member.status)
 
-    return True
 
+# Index first, getChatMember only for unknown users. Index stores
+# only statuses from chat_member updates, getChatMember answer would
+# stay forever if bot misses later leave
+
+
+async def check_chat_member(context, user_id):
+    if context.db.members_index:
+        status = await context.db.get_member(user_id)
+        if status:
+            return is_member_status(status)
+
+    return await is_chat_member(context.bot, CHAT_ID, user_id)
+
+
+# getChatMember is Telegram round trip before every private message.
+# Members rarely leave, keep positive answers longer. Strangers may
+# join any moment, recheck them soon. Concurrent checks for same
+# user share one request
+
+MEMBER_CACHE_TTL = float(getenv('MEMBER_CACHE_TTL', 600))
+NOT_MEMBER_CACHE_TTL = float(getenv('NOT_MEMBER_CACHE_TTL', 30))
+MEMBER_CACHE_SIZE = int(getenv('MEMBER_CACHE_SIZE', 10000))
+
+
+class MemberCache:
+    def __init__(
+            self,
+            ttl=MEMBER_CACHE_TTL,
+            not_member_ttl=NOT_MEMBER_CACHE_TTL,
+            size=MEMBER_CACHE_SIZE
+    ):
+        self.ttl = ttl
+        self.not_member_ttl = not_member_ttl
+        self.size = size
+
+        # user_id -> (is_member, expires), LRU order
+        self.items = OrderedDict()
+        self.flight = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        item = self.items.get(user_id)
+        if item:
+            is_member, expires = item
+            if monotonic() < expires:
+                self.items.move_to_end(user_id)
+                return is_member
+            del self.items[user_id]
 
-class ChatMemberMiddleware(BaseMiddleware):
+    def set(self, user_id, is_member):
+        ttl = self.ttl if is_member else self.not_member_ttl
+        if ttl <= 0:
+            return
+
+        self.items[user_id] = (is_member, monotonic() + ttl)
+        self.items.move_to_end(user_id)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    async def check(self, user_id, fetch):
+        is_member = self.get(user_id)
+        if is_member is not None:
+            self.hits += 1
+            return is_member
+
+        self.misses += 1
+        is_member = await self.flight.run(user_id, fetch)
+        self.set(user_id, is_member)
+        return is_member
+
+
+class ChatMemberMiddleware(TimedMiddleware):
     def __init__(self, context):
         self.context = context
         BaseMiddleware.__init__(self)
@@ -639,16 +2647,18 @@ class ChatMemberMiddleware(BaseMiddleware):
     # Only register_message_handler for private chats in
     # setup_handlers
 
+    async def is_chat_member(self, user_id):
+        return await self.context.members.check(
+            user_id,
+            lambda: check_chat_member(self.context, user_id)
+        )
+
     async def on_pre_process_message(self, message, data):
         if message.chat.type == ChatType.PRIVATE:
-            if await is_chat_member(
-                self.context.bot,
-                chat_id=CHAT_ID,
-                user_id=message.from_user.id
-            ):
+            if await self.is_chat_member(message.from_user.id):
                 return
             else:
-                await message.answer(text=NOT_CHAT_MEMBER_TEXT)
+                await answer(self.context, message, NOT_CHAT_MEMBER_TEXT)
                 raise CancelHandler
 
         else:
@@ -665,13 +2675,288 @@ class ChatMemberMiddleware(BaseMiddleware):
 
 def setup_middlewares(context):
     middlewares = [
+        DedupMiddleware(context),
         LoggingMiddleware(),
         ChatMemberMiddleware(context),
     ]
+    if context.profiler.enabled:
+        middlewares.insert(0, ProfileMiddleware(context))
     for middleware in middlewares:
         context.dispatcher.middleware.setup(middleware)
 
 
+def find_middleware(context, cls):
+    for middleware in context.dispatcher.middleware.applications:
+        if isinstance(middleware, cls):
+            return middleware
+
+
+#######
+#
+#   JOBS
+#
+#####
+
+# Background work inside bot event loop. Each container instance runs
+# own copy, keep jobs idempotent
+
+
+######
+#   PERIODIC
+####
+
+
+class Periodic:
+    def __init__(self, interval, job):
+        self.interval = interval
+        self.job = job
+        self.task = None
+
+        self.runs = 0
+        self.errors = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.loop())
+
+    async def loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.job()
+            except Exception:
+                self.errors += 1
+                log.exception('Job failed')
+            self.runs += 1
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+######
+#   RECONCILE
+#####
+
+# Telegram Bot API has no delete event and no getMessage. Instead of
+# failing forward in front of user, probe stored posts in background:
+# forward to service chat, delete copy. Bot must be able to post and
+# delete in PROBE_CHAT_ID, private channel works. Without
+# PROBE_CHAT_ID no reconcile
+
+PROBE_CHAT_ID = getenv('PROBE_CHAT_ID')
+if PROBE_CHAT_ID:
+    PROBE_CHAT_ID = int(PROBE_CHAT_ID)
+
+RECONCILE_INTERVAL = float(getenv('RECONCILE_INTERVAL', 6 * 60 * 60))
+RECONCILE_CONCURRENCY = 4
+
+# Probes per second, leave Telegram limits to users
+RECONCILE_RATE = 2
+
+
+async def probe_post(context, post, probe_chat_id):
+    try:
+        message = await context.bot.forward_message(
+            chat_id=probe_chat_id,
+            from_chat_id=CHAT_ID,
+            message_id=post.message_id
+        )
+    except (MessageToForwardNotFound, MessageIdInvalid):
+        return False
+
+    await context.bot.delete_message(
+        chat_id=probe_chat_id,
+        message_id=message.message_id
+    )
+    return True
+
+
+async def reconcile_posts(context, probe_chat_id=PROBE_CHAT_ID):
+    posts = list(await context.db.read_posts())
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    bucket = TokenBucket(RECONCILE_RATE, RECONCILE_CONCURRENCY)
+
+    async def probe(post):
+        async with semaphore:
+            await bucket.acquire()
+            await context.sender.bucket.acquire()
+            return await probe_post(context, post, probe_chat_id)
+
+    # On Telegram errors keep post, retry next time
+    results = await asyncio.gather(
+        *[probe(_) for _ in posts],
+        return_exceptions=True
+    )
+    dead = [
+        post.message_id
+        for post, result in zip(posts, results)
+        if result is False
+    ]
+    errors = sum(isinstance(_, Exception) for _ in results)
+    if dead:
+        await context.db.delete_posts(dead)
+
+    log.info(
+        f'Reconciled posts: {len(posts)} '
+        f'dead: {len(dead)} errors: {errors}'
+    )
+
+
+######
+#   MEMORY
+####
+
+# Container has 256MB. Check caches and queues stay bounded: RSS and
+# sizes in /metrics and in log every MEMORY_INTERVAL seconds.
+# MEMORY_TRACE=N starts tracemalloc with N frames, each report takes
+# snapshot and logs top growth since previous. /debug/memory does
+# same on request. Tracing costs CPU and memory, opt-in
+
+
+MEMORY_INTERVAL = int(getenv('MEMORY_INTERVAL', 0))
+MEMORY_TRACE = int(getenv('MEMORY_TRACE', 0))
+MEMORY_TOP = 10
+
+# Snapshot of bot heap is few MB, keep few
+MEMORY_SNAPSHOTS = 4
+
+PAGE_SIZE = sysconf('SC_PAGE_SIZE')
+
+
+def rss_bytes():
+    # Current RSS on Linux, peak elsewhere
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+        return pages * PAGE_SIZE
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_sizes(context):
+    db = context.db
+    cache = getattr(db, 'cache', None)
+    if cache:
+        yield 'posts_cache_size', len(cache.posts or ())
+    flight = getattr(db, 'flight', None)
+    if flight:
+        yield 'posts_flight_size', len(flight.pending)
+
+    yield 'member_cache_size', len(context.members.items)
+    yield 'member_flight_size', len(context.members.flight.pending)
+    yield 'sender_chat_buckets_size', len(context.sender.chat_buckets)
+    yield 'sender_lanes_size', len(context.sender.lanes)
+    yield 'updates_queue_size', context.updates.depth
+    yield 'chat_writes_size', len(context.chat_writes.pending)
+    yield 'profiler_samples_size', len(context.profiler.samples)
+    yield 'metrics_series_size', sum(len(_.series) for _ in HISTOGRAMS)
+
+    dedup = find_middleware(context, DedupMiddleware)
+    if dedup:
+        yield 'dedup_window_size', len(dedup.window)
+
+
+class MemoryTracker:
+    def __init__(self, trace=MEMORY_TRACE, top=MEMORY_TOP):
+        self.trace = trace
+        self.top = top
+
+        # (id, snapshot)
+        self.snapshots = deque(maxlen=MEMORY_SNAPSHOTS)
+        self.next_id = 0
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace)
+
+    def close(self):
+        if self.trace:
+            self.snapshots.clear()
+            tracemalloc.stop()
+
+    def snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        id = self.next_id
+        self.next_id += 1
+        self.snapshots.append((id, snapshot))
+        return id, snapshot
+
+    def find(self, id):
+        for other, snapshot in self.snapshots:
+            if other == id:
+                return snapshot
+
+    def diff(self, base=None):
+        # New snapshot vs base id, default previous. Top growth
+        # lines, None if nothing to compare with
+        # Find base before new snapshot evicts oldest
+        if base is not None:
+            old = self.find(base)
+        elif self.snapshots:
+            base, old = self.snapshots[-1]
+        else:
+            old = None
+        id, snapshot = self.snapshot()
+
+        lines = [f'snapshot {id}']
+        if old is None:
+            stats = snapshot.statistics('lineno')
+            lines.append('top')
+        else:
+            stats = snapshot.compare_to(old, 'lineno')
+            lines.append(f'diff to snapshot {base}')
+        lines.extend(str(_) for _ in stats[:self.top])
+        return lines
+
+
+def format_memory(context, base=None):
+    lines = [f'rss_bytes {rss_bytes()}']
+    for name, value in memory_sizes(context):
+        lines.append(f'{name} {value}')
+    if context.memory.trace:
+        lines.extend(context.memory.diff(base))
+    return lines
+
+
+async def report_memory(context):
+    log.info('Memory\n' + '\n'.join(format_memory(context)))
+
+
+######
+#   SETUP
+####
+
+
+def setup_jobs(context):
+    if context.db.snapshot:
+        context.jobs.append(Periodic(
+            POSTS_SNAPSHOT_REBUILD_INTERVAL,
+            context.db.rebuild_posts_snapshot
+        ))
+
+    if ARCHIVE_EVENTS:
+        context.jobs.append(Periodic(
+            ARCHIVE_EVENTS_INTERVAL,
+            context.db.archive_events
+        ))
+
+    if MEMORY_INTERVAL:
+        context.jobs.append(Periodic(
+            MEMORY_INTERVAL,
+            lambda: report_memory(context)
+        ))
+
+    if PROBE_CHAT_ID:
+        context.jobs.append(Periodic(
+            RECONCILE_INTERVAL,
+            lambda: reconcile_posts(context)
+        ))
+
+
 #######
 #
 #   BOT
@@ -679,6 +2964,103 @@ def setup_middlewares(context):
 #####
 
 
+########
+#   UPDATE QUEUE
+######
+
+# Optional. Answer webhook at once, process update later on worker
+# pool. Slow updates do not hold YC concurrency slots, Telegram does
+# not redeliver updates on timeout. Nuance: YC may throttle container
+# between requests, keep UPDATE_WORKERS=0 if background work stalls
+
+UPDATE_WORKERS = int(getenv('UPDATE_WORKERS', 0))
+UPDATE_QUEUE_SIZE = int(getenv('UPDATE_QUEUE_SIZE', 100))
+UPDATE_QUEUE_DRAIN_TIMEOUT = 10
+
+
+class UpdateQueue:
+    def __init__(
+            self, dispatcher,
+            workers=UPDATE_WORKERS,
+            size=UPDATE_QUEUE_SIZE
+    ):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=size)
+        self.tasks = []
+
+        self.max_depth = 0
+        self.processed = 0
+        self.dropped = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self.work())
+            for _ in range(self.workers)
+        ]
+
+    def put(self, update):
+        try:
+            self.queue.put_nowait((update, monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    async def work(self):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+
+        while True:
+            update, enqueued = await self.queue.get()
+            wait = monotonic() - enqueued
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+            try:
+                await self.dispatcher.updates_handler.notify(update)
+            except Exception:
+                log.exception(f'Failed update id: {update.update_id}')
+            finally:
+                self.processed += 1
+                self.queue.task_done()
+
+    async def close(self, timeout=UPDATE_QUEUE_DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f'Dropped {self.depth} queued updates')
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+UPDATE_QUEUE_KEY = 'UPDATE_QUEUE'
+
+
+class QueueWebhookRequestHandler(WebhookRequestHandler):
+    async def post(self):
+        self.validate_ip()
+        dispatcher = self.get_dispatcher()
+        update = await self.parse_update(dispatcher.bot)
+
+        queue = self.request.app[UPDATE_QUEUE_KEY]
+        if queue.put(update):
+            return web.Response(text='ok')
+
+        # Queue is full, Telegram redelivers later
+        return web.Response(status=503)
+
+
 ########
 #   WEBHOOK
 ######
@@ -686,11 +3068,131 @@ def setup_middlewares(context):
 
 async def on_startup(context, _):
     await context.db.connect()
+    context.commands_task = asyncio.create_task(
+        setup_commands_background(context)
+    )
+    context.updates.start()
+    context.profiler.start()
+    context.memory.start()
+    for job in context.jobs:
+        job.start()
 
 
 async def on_shutdown(context, _):
+    context.commands_task.cancel()
+    for job in context.jobs:
+        await job.close()
+    await context.updates.close()
+    await context.chat_writes.close()
+    context.profiler.close()
+    context.memory.close()
     await context.db.close()
 
+    session = await context.bot.get_session()
+    await session.close()
+
+
+# YC Serverless Container is assigned with endpoint
+# https://bba......v7v9.containers.yandexcloud.net/
+WEBHOOK_PATH = '/'
+
+
+######
+#   METRICS
+#####
+
+
+METRICS_PATH = '/metrics'
+BOT_CONTEXT_KEY = 'BOT_CONTEXT'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def context_counters(context):
+    updates = context.updates
+    yield 'updates_processed_total', updates.processed
+    yield 'updates_dropped_total', updates.dropped
+    yield 'updates_wait_seconds_total', updates.wait_total
+    yield 'sender_retried_total', context.sender.retried
+
+    members = context.members
+    yield 'member_cache_hits_total', members.hits
+    yield 'member_cache_misses_total', members.misses
+    yield 'member_cache_evictions_total', members.evictions
+    yield 'member_flight_coalesced_total', members.flight.coalesced
+
+    cache = getattr(context.db, 'cache', None)
+    if cache:
+        yield 'posts_cache_hits_total', cache.hits
+        yield 'posts_cache_misses_total', cache.misses
+    flight = getattr(context.db, 'flight', None)
+    if flight:
+        yield 'posts_flight_coalesced_total', flight.coalesced
+
+    dedup = find_middleware(context, DedupMiddleware)
+    if dedup:
+        yield 'dedup_duplicates_total', dedup.duplicates
+
+
+def context_gauges(context):
+    yield 'updates_queue_depth', context.updates.depth
+    yield 'updates_queue_max_depth', context.updates.max_depth
+    yield 'updates_wait_seconds_max', context.updates.wait_max
+    yield 'sender_pending', context.sender.pending
+    yield 'rss_bytes', rss_bytes()
+    yield from memory_sizes(context)
+
+
+async def handle_metrics(request):
+    context = request.app[BOT_CONTEXT_KEY]
+    text = format_metrics(
+        context_counters(context),
+        context_gauges(context)
+    )
+    return web.Response(
+        body=text.encode('utf8'),
+        headers={'Content-Type': METRICS_CONTENT_TYPE}
+    )
+
+
+# Snapshot walks whole heap and is kept in memory. Public endpoint,
+# only with MEMORY_TRACE set
+
+MEMORY_PATH = '/debug/memory'
+
+
+async def handle_memory(request):
+    # ?base=<snapshot id> to diff with older snapshot
+    context = request.app[BOT_CONTEXT_KEY]
+    base = request.query.get('base')
+    if base is not None:
+        try:
+            base = int(base)
+        except ValueError:
+            raise web.HTTPBadRequest(text=f'Bad base: {base!r}')
+        if context.memory.find(base) is None:
+            raise web.HTTPBadRequest(text=f'No snapshot: {base}')
+    lines = format_memory(context, base)
+    return web.Response(text='\n'.join(lines) + '\n')
+
+
+def make_app(context):
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = context.dispatcher
+
+    handler = WebhookRequestHandler
+    if context.updates.workers:
+        app[UPDATE_QUEUE_KEY] = context.updates
+        handler = QueueWebhookRequestHandler
+    app.router.add_route('*', WEBHOOK_PATH, handler)
+    app[BOT_CONTEXT_KEY] = context
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    if context.memory.trace:
+        app.router.add_get(MEMORY_PATH, handle_memory)
+
+    app.on_startup.append(context.on_startup)
+    app.on_shutdown.append(context.on_shutdown)
+    return app
+
 
 # YC Serverless Containers requires PORT env var
 # https://cloud.yandex.ru/docs/serverless-containers/concepts/runtime#peremennye-okruzheniya
@@ -698,18 +3200,10 @@ PORT = getenv('PORT', 8080)
 
 
 def run(context):
-    executor.start_webhook(
-        dispatcher=context.dispatcher,
-
-        # YC Serverless Container is assigned with endpoint
-        # https://bba......v7v9.containers.yandexcloud.net/
-        webhook_path='/',
-
+    web.run_app(
+        context.make_app(),
         port=PORT,
 
-        on_startup=context.on_startup,
-        on_shutdown=context.on_shutdown,
-
         # Disable aiohttp "Running on ... Press CTRL+C"
         # Polutes YC Logging
         print=None
@@ -721,11 +3215,34 @@ def run(context):
 ######
 
 
+# Defaults from env. Tests and load test inject bot, db and config
+
+
 class BotContext:
-    def __init__(self):
-        self.bot = Bot(token=BOT_TOKEN)
+    def __init__(
+            self,
+            bot=None,
+            db=None,
+            workers=UPDATE_WORKERS,
+            write_window=CHAT_WRITE_WINDOW,
+            webhook_reply=WEBHOOK_REPLY,
+            profiler=None,
+            memory=None
+    ):
+        self.bot = bot or TimedBot(token=BOT_TOKEN)
         self.dispatcher = Dispatcher(self.bot)
-        self.db = DB()
+        self.db = db or make_db()
+        self.members = MemberCache()
+        self.sender = Sender()
+        self.updates = UpdateQueue(self.dispatcher, workers=workers)
+        self.chat_writes = ChatWrites(self, window=write_window)
+        self.profiler = profiler or Profiler()
+        self.memory = memory or MemoryTracker()
+        self.jobs = []
+        self.commands_task = None
+
+        # Webhook response is sent before update is processed
+        self.webhook_reply = webhook_reply and not workers
 
 
 BotContext.handle_start_command = handle_start_command
@@ -741,14 +3258,190 @@ BotContext.handle_other = handle_other
 BotContext.handle_chat_new_message = handle_chat_new_message
 BotContext.handle_chat_edited_message = handle_chat_edited_message
 
+BotContext.handle_chat_member = handle_chat_member
+BotContext.handle_my_chat_member = handle_my_chat_member
+
+time_handlers(BotContext)
+
+BotContext.setup_commands = setup_commands
 BotContext.setup_handlers = setup_handlers
 BotContext.setup_middlewares = setup_middlewares
+BotContext.setup_jobs = setup_jobs
 
 BotContext.on_startup = on_startup
 BotContext.on_shutdown = on_shutdown
+BotContext.make_app = make_app
 BotContext.run = run
 
 
+######
+#
+#   BACKFILL
+#
+#####
+
+# Posts written before bot joined chat. Telegram Desktop -> Export
+# chat history -> JSON, result.json
+
+
+######
+#   JSON STREAM
+#####
+
+# Export of our chat is hundreds of MB, do not load whole file.
+# Decode one value at a time, buffer holds single message plus
+# chunk
+
+
+EXPORT_CHUNK_SIZE = 1 << 16
+JSON_WHITESPACE = ' \t\n\r'
+
+
+class JsonStream:
+    def __init__(self, file, chunk_size=EXPORT_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.read = 0
+
+    def fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.read += len(chunk)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while (
+                    self.pos < len(self.buffer)
+                    and self.buffer[self.pos] in JSON_WHITESPACE
+            ):
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.skip(char):
+            raise ValueError(f'Expected {char!r} at {self.read}')
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+
+            # 12 of 123 cut by chunk border
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+
+def read_export_messages(file, chunk_size=EXPORT_CHUNK_SIZE):
+    # {"name": ..., "type": ..., "id": ..., "messages": [...]}
+
+    stream = JsonStream(file, chunk_size)
+    stream.expect('{')
+    while not stream.skip('}'):
+        key = stream.value()
+        stream.expect(':')
+        if key == 'messages':
+            stream.expect('[')
+            while not stream.skip(']'):
+                yield stream.value()
+                stream.skip(',')
+        else:
+            stream.value()
+        stream.skip(',')
+
+
+# "text": "Событие #event 2022-07-09"
+# "text": ["Событие ", {"type": "hashtag", "text": "#event"}, " 2022-07-09"]
+
+
+def export_message_text(message):
+    text = message.get('text', '')
+    if isinstance(text, list):
+        text = ''.join(
+            _ if isinstance(_, str) else _['text']
+            for _ in text
+        )
+    return text
+
+
+######
+#   WRITE
+####
+
+
+BACKFILL_BATCH = 500
+BACKFILL_CONCURRENCY = 4
+BACKFILL_LOG_EVERY = 10000
+
+
+async def backfill(db, path, chunk_size=EXPORT_CHUNK_SIZE):
+    start = monotonic()
+    messages = 0
+    posts = 0
+    batch = []
+
+    def report():
+        rate = messages / max(monotonic() - start, 1e-6)
+        log.info(
+            f'Messages: {messages} posts: {posts} '
+            f'rate: {rate:.0f} messages/s'
+        )
+
+    async def flush():
+        nonlocal posts, batch
+        await db.put_posts(batch, BACKFILL_CONCURRENCY)
+        posts += len(batch)
+        batch = []
+
+    with open(path, encoding='utf8') as file:
+        for message in read_export_messages(file, chunk_size):
+            messages += 1
+            if messages % BACKFILL_LOG_EVERY == 0:
+                report()
+
+            if message.get('type') != 'message':
+                continue
+
+            footer = parse_post_footer(export_message_text(message))
+            if footer:
+                post = Post(message['id'], footer.type, footer.event_date)
+                batch.append(post)
+                if len(batch) >= BACKFILL_BATCH:
+                    await flush()
+
+    if batch:
+        await flush()
+    report()
+
+
 ######
 #
 #   MAIN
@@ -756,8 +3449,64 @@ BotContext.run = run
 #####
 
 
+async def run_command(db, command, *args):
+    await db.connect()
+    try:
+        await command(db, *args)
+    finally:
+        await db.close()
+
+
+MIGRATE_COMMAND = 'migrate'
+BACKFILL_COMMAND = 'backfill'
+ARCHIVE_COMMAND = 'archive'
+SNAPSHOT_COMMAND = 'snapshot'
+
+
+def main():
+    parser = ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser(
+        MIGRATE_COMMAND,
+        help='create posts indexes'
+    )
+    backfill_parser = commands.add_parser(
+        BACKFILL_COMMAND,
+        help='write posts from Telegram Desktop export'
+    )
+    backfill_parser.add_argument('path', help='result.json')
+    commands.add_parser(
+        ARCHIVE_COMMAND,
+        help='move past events to archived_events'
+    )
+    commands.add_parser(
+        SNAPSHOT_COMMAND,
+        help='rebuild posts snapshot'
+    )
+    args = parser.parse_args()
+
+    if args.command == MIGRATE_COMMAND:
+        asyncio.run(run_command(DB(), create_posts_indexes))
+
+    elif args.command == BACKFILL_COMMAND:
+        asyncio.run(run_command(make_db(), backfill, args.path))
+
+    elif args.command == ARCHIVE_COMMAND:
+        asyncio.run(run_command(
+            make_db(),
+            lambda db: db.archive_events()
+        ))
+
+    elif args.command == SNAPSHOT_COMMAND:
+        asyncio.run(run_command(DB(), rebuild_posts_snapshot))
+
+    else:
+        context = BotContext()
+        context.setup_handlers()
+        context.setup_middlewares()
+        context.setup_jobs()
+        context.run()
+
+
 if __name__ == '__main__':
-    context = BotContext()
-    context.setup_handlers()
-    context.setup_middlewares()
-    context.run()
+    main()
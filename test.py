@@ -1,6 +1,9 @@
 
 import asyncio
+from collections import deque
 import datetime
+from os import getenv
+from itertools import chain
 from json import (
     loads as parse_json,
     dumps as format_json
@@ -10,8 +13,11 @@ import pytest
 
 from aiogram.types import (
     Update,
+    Message,
     ChatMember
 )
+from aiogram.dispatcher.webhook import BaseResponse
+from botocore.exceptions import ClientError
 
 from main import (
     Bot,
@@ -21,11 +27,42 @@ from main import (
 
     DB,
     BotContext,
+    MemberCache,
+    Sender,
+    UpdateQueue,
+    UpdateWindow,
+    DedupMiddleware,
+    ChatWrites,
+    Periodic,
+    reconcile_posts,
+    create_posts_indexes,
+    setup_commands_background,
+    RetryAfter,
+    dynamo_scan,
+    dynamo_format_post,
+    MemoryDB,
+    SqliteDB,
+    FaultyDB,
+    Histogram,
+    Profiler,
+    MemoryTracker,
+    Timer,
+    TimedDynamoClient,
+    read_posts_snapshot,
+    scan_posts,
+    write_posts_snapshot,
 
     Date,
 
     Post,
+    PostStore,
+    PostFooter,
     find_post,
+    find_posts,
+    select_posts,
+
+    read_export_messages,
+    backfill,
 )
 
 
@@ -54,15 +91,652 @@ async def db():
     await db.close()
 
 
-async def test_db_posts(db):
+# Mock Dynamo client, keep items in dict per table. Test DB logic
+# without network
+
+
+class FakeDynamoClient:
+    def __init__(self):
+        self.tables = {}
+        self.trace = []
+        self.page_size = None
+
+        # Number of batch writes to leave one request unprocessed
+        self.throttle = 0
+
+        # posts GSI name -> status, build takes one describe_table
+        self.indexes = {}
+
+        self.keys = {
+            'posts': 'message_id',
+            'members': 'user_id',
+            'updates': 'update_id',
+            'snapshots': 'snapshot',
+            'archived_events': 'message_id',
+        }
+
+    def table(self, name):
+        return self.tables.setdefault(name, {})
+
+    def key(self, table, item):
+        value, = item[self.keys[table]].values()
+        return value
+
+    async def scan(self, TableName, ExclusiveStartKey=None,
+                   Segment=0, TotalSegments=1):
+        self.trace.append('scan')
+
+        items = list(self.table(TableName).values())
+        items = items[Segment::TotalSegments]
+        if ExclusiveStartKey:
+            index = items.index(ExclusiveStartKey)
+            items = items[index + 1:]
+
+        response = {'Items': items}
+        if self.page_size and len(items) > self.page_size:
+            items = items[:self.page_size]
+            response = {
+                'Items': items,
+                'LastEvaluatedKey': items[-1]
+            }
+        return response
+
+    async def query(self, TableName, IndexName, KeyConditionExpression,
+                    ExpressionAttributeNames, ExpressionAttributeValues,
+                    ScanIndexForward, Limit=None, ExclusiveStartKey=None):
+        self.trace.append('query')
+
+        key = {
+            'type_event_date': 'event_date',
+            'type_message_id': 'message_id',
+        }[IndexName]
+        values = ExpressionAttributeValues
+        items = [
+            _ for _ in self.table(TableName).values()
+            if _['type'] == values[':type'] and key in _
+        ]
+        if ':start' in values:
+            items = [
+                _ for _ in items
+                if _['event_date']['S'] >= values[':start']['S']
+            ]
+
+        def sort_key(item):
+            type, value = next(iter(item[key].items()))
+            return int(value) if type == 'N' else value
+
+        items.sort(key=sort_key, reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            items = items[items.index(ExclusiveStartKey) + 1:]
+
+        response = {'Items': items}
+        if Limit and len(items) > Limit:
+            items = items[:Limit]
+            response = {
+                'Items': items,
+                'LastEvaluatedKey': items[-1]
+            }
+        return response
+
+    async def put_item(self, TableName, Item, ConditionExpression=None,
+                       ExpressionAttributeNames=None,
+                       ExpressionAttributeValues=None):
+        self.trace.append('put_item')
+        key = self.key(TableName, Item)
+        table = self.table(TableName)
+
+        failed = False
+        if not ConditionExpression:
+            pass
+        elif ConditionExpression.startswith('attribute_not_exists'):
+            failed = key in table
+        else:
+            # #name = :value
+            name, value = ConditionExpression.split(' = ')
+            name = ExpressionAttributeNames[name]
+            value = ExpressionAttributeValues[value]
+            failed = key not in table or table[key].get(name) != value
+
+        if failed:
+            raise ClientError(
+                {'Error': {'Code': 'ConditionalCheckFailedException'}},
+                'PutItem'
+            )
+
+        table[key] = Item
+
+    async def get_item(self, TableName, Key):
+        self.trace.append('get_item')
+        key = self.key(TableName, Key)
+        item = self.table(TableName).get(key)
+        return {'Item': item} if item else {}
+
+    async def describe_table(self, TableName):
+        self.trace.append('describe_table')
+        indexes = [
+            {'IndexName': name, 'IndexStatus': status}
+            for name, status in self.indexes.items()
+        ]
+        for name in self.indexes:
+            self.indexes[name] = 'ACTIVE'
+        return {'Table': {'GlobalSecondaryIndexes': indexes}}
+
+    async def update_table(self, TableName, AttributeDefinitions,
+                           GlobalSecondaryIndexUpdates):
+        self.trace.append('update_table')
+        if 'CREATING' in self.indexes.values():
+            raise ClientError(
+                {'Error': {'Code': 'LimitExceededException'}},
+                'UpdateTable'
+            )
+        for update in GlobalSecondaryIndexUpdates:
+            self.indexes[update['Create']['IndexName']] = 'CREATING'
+
+    async def delete_item(self, TableName, Key):
+        self.trace.append('delete_item')
+        key = self.key(TableName, Key)
+        self.table(TableName).pop(key, None)
+
+    async def batch_write_item(self, RequestItems):
+        self.trace.append('batch_write_item')
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            assert len(requests) <= 25
+            if self.throttle:
+                self.throttle -= 1
+                unprocessed[name] = requests[-1:]
+                requests = requests[:-1]
+
+            table = self.table(name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    table[self.key(name, item)] = item
+                else:
+                    key = request['DeleteRequest']['Key']
+                    table.pop(self.key(name, key), None)
+        return {'UnprocessedItems': unprocessed}
+
+
+@pytest.fixture(scope='function')
+def fake_db():
+    db = DB()
+    db.client = FakeDynamoClient()
+    return db
+
+
+async def test_db_cache(fake_db):
+    post = Post(type='chats', message_id=1)
+    await fake_db.put_post(post)
+
+    assert list(await fake_db.read_posts()) == [post]
+    assert list(await fake_db.read_posts()) == [post]
+    assert fake_db.client.trace == ['put_item', 'scan']
+    assert fake_db.cache.hits == 1
+    assert fake_db.cache.misses == 1
+
+    # Write through, no rescan
+    other = Post(type='contacts', message_id=2)
+    await fake_db.put_post(other)
+    await fake_db.delete_post(post.message_id)
+    assert list(await fake_db.read_posts()) == [other]
+    assert fake_db.client.trace.count('scan') == 1
+
+    # Expired
+    fake_db.cache.expires = 0
+    assert list(await fake_db.read_posts()) == [other]
+    assert fake_db.client.trace.count('scan') == 2
+
+
+async def test_db_snapshot(fake_db):
+    fake_db.snapshot = True
+    posts = [
+        Post(type='chats', message_id=1),
+        Post(type='event', message_id=2, event_date=Date(2022, 7, 9)),
+    ]
+
+    # Writers do not create snapshot, only rebuild does
+    await fake_db.put_post(posts[0])
+    assert await read_posts_snapshot(fake_db) == (None, None)
+    assert fake_db.client.trace.count('scan') == 0
+
+    await fake_db.rebuild_posts_snapshot()
+    await fake_db.put_post(posts[1])
+    await fake_db.delete_post(1)
+    await fake_db.put_post(Post(type='contacts', message_id=3))
+
+    version, snapshot = await read_posts_snapshot(fake_db)
+    assert version == 5
+    assert list(snapshot) == [posts[1], Post(type='contacts', message_id=3)]
+
+    fake_db.cache.clear()
+    fake_db.client.trace.clear()
+    assert list(await fake_db.read_posts()) == list(snapshot)
+    assert fake_db.client.trace == ['get_item']
+
+    # Conflict with concurrent writer, retry on fresh version
+    stale = fake_db.client.tables['snapshots']['posts']
+    await fake_db.put_post(Post(type='chats', message_id=4))
+    with pytest.raises(ClientError):
+        await write_posts_snapshot(fake_db, snapshot, version)
+    assert fake_db.client.tables['snapshots']['posts'] is not stale
+
+    # Writer crashed between table and snapshot, rebuild catches up
+    await fake_db.client.put_item(
+        TableName='posts',
+        Item=dynamo_format_post(Post(type='chats', message_id=5))
+    )
+    await fake_db.rebuild_posts_snapshot()
+    _, snapshot = await read_posts_snapshot(fake_db)
+    assert [_.message_id for _ in snapshot] == [2, 3, 4, 5]
+
+
+async def test_db_snapshot_create_race(fake_db, monkeypatch):
+    fake_db.snapshot = True
+    await fake_db.put_post(Post(type='chats', message_id=1))
+
+    scans = []
+
+    async def racing_scan_posts(db):
+        posts = await scan_posts(db)
+        if not scans:
+            # Writer sees no snapshot yet, skips it
+            await fake_db.put_post(Post(type='chats', message_id=2))
+        scans.append(posts)
+        return posts
+
+    monkeypatch.setattr('main.scan_posts', racing_scan_posts)
+    await fake_db.rebuild_posts_snapshot()
+    _, snapshot = await read_posts_snapshot(fake_db)
+    assert [_.message_id for _ in snapshot] == [1, 2]
+
+
+async def test_db_snapshot_too_large(fake_db, monkeypatch):
+    fake_db.snapshot = True
+    await fake_db.put_post(Post(type='chats', message_id=1))
+    await fake_db.rebuild_posts_snapshot()
+    assert 'posts' in fake_db.client.tables['snapshots']
+
+    monkeypatch.setattr('main.SNAPSHOT_MAX_SIZE', 1)
+    await fake_db.put_post(Post(type='chats', message_id=2))
+    assert 'posts' not in fake_db.client.tables['snapshots']
+
+    fake_db.cache.clear()
+    posts = await fake_db.read_posts()
+    assert [_.message_id for _ in posts] == [1, 2]
+
+
+async def test_db_archive_events(fake_db):
+    fake_db.snapshot = True
+    posts = [
+        Post(type='event', message_id=1, event_date=Date(2022, 6, 1)),
+        Post(type='event', message_id=2, event_date=Date(2022, 7, 1)),
+        Post(type='event', message_id=3, event_date=Date(2022, 7, 5)),
+        Post(type='chats', message_id=4),
+    ]
+    await fake_db.put_posts(posts)
+
+    archived = await fake_db.archive_events(today=Date(2022, 7, 9))
+    assert archived == posts[:2]
+    assert list(await fake_db.read_archived_events()) == posts[1::-1]
+
+    fake_db.cache.clear()
+    assert list(await fake_db.read_posts()) == posts[2:]
+
+    # Keep newest event hot, even if past
+    archived = await fake_db.archive_events(today=Date(2022, 8, 1))
+    assert archived == []
+
+
+async def test_histogram():
+    histogram = Histogram('test_seconds', ('operation',), (0.1, 1))
+    client = TimedDynamoClient(FakeDynamoClient())
+    with Timer(histogram, 'put_item'):
+        await client.put_item(
+            TableName='posts',
+            Item=dynamo_format_post(Post(type='chats', message_id=1))
+        )
+    histogram.observe(0.5, 'get_item')
+    histogram.observe(5, 'get_item')
+
+    lines = list(histogram.format())
+    assert lines[:-2] == [
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{operation="get_item",le="0.1"} 0',
+        'test_seconds_bucket{operation="get_item",le="1"} 1',
+        'test_seconds_bucket{operation="get_item",le="+Inf"} 2',
+        'test_seconds_sum{operation="get_item"} 5.5',
+        'test_seconds_count{operation="get_item"} 2',
+        'test_seconds_bucket{operation="put_item",le="0.1"} 1',
+        'test_seconds_bucket{operation="put_item",le="1"} 1',
+        'test_seconds_bucket{operation="put_item",le="+Inf"} 1',
+    ]
+
+    # put_item time is real, check bounds
+    sum_line, count_line = lines[-2:]
+    name, value = sum_line.split(' ')
+    assert name == 'test_seconds_sum{operation="put_item"}'
+    assert 0 < float(value) < 0.1
+    assert count_line == 'test_seconds_count{operation="put_item"} 1'
+    assert client.client.trace == ['put_item']
+
+
+async def test_db_single_flight(fake_db):
+    await fake_db.put_post(Post(type='chats', message_id=1))
+    fake_db.client.trace = []
+
+    results = await asyncio.gather(*[
+        fake_db.read_posts()
+        for _ in range(5)
+    ])
+    assert all(_ is results[0] for _ in results)
+    assert fake_db.client.trace == ['scan']
+    assert fake_db.flight.coalesced == 4
+
+    # Write during scan, do not cache stale scan
+    fake_db.cache.clear()
+    version = fake_db.cache.version
+    await fake_db.put_post(Post(type='chats', message_id=2))
+    fake_db.cache.set(PostStore(), version)
+    assert fake_db.cache.posts is None
+
+
+async def test_db_batch_write(fake_db):
+    fake_db.client.throttle = 2
+    posts = [
+        Post(type='chats', message_id=_)
+        for _ in range(60)
+    ]
+    await fake_db.put_posts(posts, concurrency=2)
+    assert len(fake_db.client.table('posts')) == 60
+    assert fake_db.client.trace.count('batch_write_item') == 5
+
+    fake_db.client.trace = []
+    await fake_db.delete_posts(range(10, 60))
+    assert fake_db.client.trace.count('batch_write_item') == 2
+    posts = await fake_db.read_posts()
+    assert len(posts) == 10
+
+
+async def test_db_create_indexes(fake_db):
+    client = fake_db.client
+    client.indexes = {'type_event_date': 'CREATING'}
+    await create_posts_indexes(fake_db, interval=0)
+    assert client.indexes == {
+        'type_event_date': 'ACTIVE',
+        'type_message_id': 'ACTIVE',
+    }
+    assert client.trace == [
+        'describe_table',
+        'describe_table',
+        'update_table',
+        'describe_table',
+        'describe_table',
+    ]
+
+
+async def test_db_put_update(fake_db):
+    assert await fake_db.put_update(1)
+    assert not await fake_db.put_update(1)
+    assert await fake_db.put_update(2)
+
+    await fake_db.delete_update(1)
+    assert await fake_db.put_update(1)
+
+
+async def test_db_scan_pages(fake_db):
+    client = fake_db.client
+    client.page_size = 2
+    for message_id in range(5):
+        post = Post(type='chats', message_id=message_id)
+        await client.put_item('posts', dynamo_format_post(post))
+
+    for segments in [1, 3]:
+        client.trace = []
+        items = [
+            _ async for _ in dynamo_scan(client, 'posts', segments)
+        ]
+        assert len(items) == 5
+        assert len(client.trace) == 3
+
+    posts = await fake_db.read_posts()
+    assert len(posts) == 5
+
+
+async def test_db_scan_stop_early(fake_db):
+    client = fake_db.client
+    client.page_size = 1
+    for message_id in range(10):
+        post = Post(type='chats', message_id=message_id)
+        await client.put_item('posts', dynamo_format_post(post))
+
+    tasks = asyncio.all_tasks()
+    items = dynamo_scan(client, 'posts', 2)
+    async for _ in items:
+        break
+    await items.aclose()
+
+    # Segments blocked on full queue are cancelled and awaited
+    assert asyncio.all_tasks() == tasks
+
+
+async def test_db_read_by_type(fake_db):
+    posts = [
+        Post(type='chats', message_id=1),
+        Post(type='chats', message_id=2),
+        Post(type='event', message_id=3, event_date=Date(2020, 8, 1)),
+        Post(type='event', message_id=4, event_date=Date(2030, 8, 2)),
+        Post(type='event', message_id=5, event_date=Date(2030, 8, 1)),
+    ]
+    for post in posts:
+        await fake_db.put_post(post)
+
+    def ids(posts):
+        return [_.message_id for _ in posts]
+
+    for indexes in [True, False]:
+        fake_db.indexes = indexes
+        fake_db.client.trace = []
+        fake_db.cache.clear()
+
+        assert ids(await fake_db.read_posts_by_type('chats', limit=1)) == [2]
+        assert ids(await fake_db.read_posts_by_type(
+            'event', start=Date(2030, 1, 1)
+        )) == [5, 4]
+        assert ids(await fake_db.read_posts_by_type('contacts')) == []
+
+        if indexes:
+            assert fake_db.client.trace == ['query'] * 3
+        else:
+            assert fake_db.client.trace == ['scan']
+
+
+async def test_db_get_post(fake_db):
+    post = Post(type='chats', message_id=1)
+    await fake_db.put_post(post)
+    fake_db.client.trace = []
+
+    assert await fake_db.get_post(1) == post
+    assert await fake_db.get_post(2) is None
+    assert fake_db.client.trace == ['get_item', 'get_item']
+
+    await fake_db.read_posts()
+    fake_db.client.trace = []
+    assert await fake_db.get_post(1) == post
+    assert await fake_db.get_post(2) is None
+    assert fake_db.client.trace == []
+
+    # Written by other container, seen after cache expires
+    other = Post(type='contacts', message_id=2)
+    await fake_db.client.put_item('posts', dynamo_format_post(other))
+    assert await fake_db.get_post(2) is None
+    fake_db.cache.clear()
+    assert await fake_db.get_post(2) == other
+    assert fake_db.client.trace == ['put_item', 'get_item']
+
+
+EXPORT_JSON = '''{
+ "name": "shad15_bot_test_chat",
+ "type": "private_supergroup",
+ "id": 1432443813,
+ "messages": [
+  {"id": 1, "type": "service", "action": "create_group", "text": ""},
+  {"id": 22, "type": "message", "text": "Событие #event 2030-08-01"},
+  {"id": 23, "type": "message", "text": ["Чаты ", {"type": "hashtag", "text": "#chats"}]},
+  {"id": 24, "type": "message", "text": "Просто сообщение"}
+ ]
+}'''
+
+
+def test_read_export_messages(tmp_path):
+    path = tmp_path / 'result.json'
+    path.write_text(EXPORT_JSON)
+    for chunk_size in [1, 7, 1 << 16]:
+        with open(path) as file:
+            messages = list(read_export_messages(file, chunk_size))
+        assert [_['id'] for _ in messages] == [1, 22, 23, 24]
+
+
+async def test_backfill(fake_db, tmp_path):
+    path = tmp_path / 'result.json'
+    path.write_text(EXPORT_JSON)
+    await backfill(fake_db, path, chunk_size=16)
+    posts = await fake_db.read_posts()
+    assert sorted(_.message_id for _ in posts) == [22, 23]
+    assert posts.get(23).type == 'chats'
+
+
+def test_post_store():
+    posts = PostStore([
+        Post(type='chats', message_id=3),
+        Post(type='chats', message_id=1),
+        Post(type='event', message_id=2, event_date=Date(2030, 8, 1)),
+    ])
+    assert posts.get(2).type == 'event'
+    assert posts.latest('chats').message_id == 3
+    assert [_.message_id for _ in posts.all('chats')] == [1, 3]
+    assert [_.message_id for _ in posts.newest('chats', 1)] == [3]
+    assert [_.message_id for _ in posts.newest('chats', 5)] == [3, 1]
+    assert [_.message_id for _ in posts.newest('chats')] == [3, 1]
+    assert posts.newest('chats', 0) == []
+    assert not posts.latest('contacts')
+
+    # Footer changed type
+    posts.put(Post(type='contacts', message_id=3))
+    assert posts.latest('chats').message_id == 1
+    assert posts.latest('contacts').message_id == 3
+
+    posts.delete(1)
+    assert posts.all('chats') == []
+    assert len(posts) == 2
+
+    assert find_post(posts, message_id=2) == posts.get(2)
+    assert list(find_posts(list(posts), type='contacts')) == [posts.get(3)]
+
+
+def test_post_store_events():
+    posts = PostStore([
+        Post(type='event', message_id=1, event_date=Date(2030, 8, 3)),
+        Post(type='event', message_id=2, event_date=Date(2030, 8, 1)),
+        Post(type='event', message_id=3, event_date=Date(2030, 8, 2)),
+        Post(type='chats', message_id=4),
+    ])
+
+    def ids(posts):
+        return [_.message_id for _ in posts]
+
+    assert ids(posts.select_events(Date(2030, 8, 1))) == [2, 3, 1]
+    assert ids(posts.select_events(Date(2030, 8, 2), cap=1)) == [3]
+    assert ids(posts.select_events(
+        Date(2030, 8, 1), stop=Date(2030, 8, 3)
+    )) == [2, 3]
+
+    posts.delete(3)
+    posts.put(Post(type='event', message_id=1, event_date=Date(2030, 7, 1)))
+    assert ids(posts.select_events(Date(2030, 7, 1))) == [1, 2]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+async def backend_db(request):
+    if request.param == 'memory':
+        db = MemoryDB()
+    else:
+        db = SqliteDB(':memory:')
+    await db.connect()
+    yield db
+    await db.close()
+
+
+async def test_backend_posts(backend_db):
+    db = backend_db
+    posts = [
+        Post(type='event', message_id=1, event_date=Date(2022, 6, 1)),
+        Post(type='event', message_id=2, event_date=Date(2022, 7, 9)),
+        Post(type='event', message_id=3, event_date=Date(2022, 7, 5)),
+        Post(type='chats', message_id=4),
+        Post(type='chats', message_id=5),
+    ]
+    await db.put_posts(posts[:3])
+    await db.put_post(posts[3])
+    await db.put_post(posts[4])
+
+    assert list(await db.read_posts()) == posts
+    assert await db.get_post(4) == posts[3]
+    assert await db.get_post(6) is None
+
+    for type, start, limit in [
+            ('chats', None, 1),
+            ('chats', None, None),
+            ('event', Date(2022, 7, 1), 1),
+            ('event', Date(2022, 7, 1), None),
+            ('event', None, None),
+    ]:
+        assert (
+            list(await db.read_posts_by_type(type, start, limit))
+            == select_posts(posts, type, start, limit)
+        )
+
+    await db.delete_post(5)
+    await db.delete_posts([4])
+    assert list(await db.read_posts()) == posts[:3]
+
+    assert await db.archive_events(today=Date(2022, 7, 9)) == [posts[0]]
+    assert list(await db.read_archived_events()) == [posts[0]]
+    assert list(await db.read_posts()) == posts[1:3]
+
+    assert await db.get_member(1) is None
+    await db.put_member(1, 'member')
+    assert await db.get_member(1) == 'member'
+
+    assert await db.put_update(1)
+    assert not await db.put_update(1)
+    await db.delete_update(1)
+    assert await db.put_update(1)
+
+
+async def test_faulty_db():
+    db = FaultyDB(MemoryDB(), latency=0.001, errors=0.5, seed=1)
+    db.indexes = True
+    assert not db.db.indexes
+
+    results = await asyncio.gather(
+        *[db.put_update(_) for _ in range(100)],
+        return_exceptions=True
+    )
+    errors = [_ for _ in results if isinstance(_, ClientError)]
+    assert len(errors) == db.failures
+    assert 30 < db.failures < 70
+    assert db.calls == 100
+    assert len(db.db.updates) == 100 - db.failures
+
+
+async def check_db_posts(db):
     post = Post(
         type='test',
         message_id=-1,
         event_date=Date.fromisoformat('2020-01-01')
     )
 
-    # Yep, insert in prod DB. Type "test" should not interfere with
-    # working bot
     await db.put_post(post)
 
     posts = await db.read_posts()
@@ -73,6 +747,22 @@ async def test_db_posts(db):
     assert not find_post(posts, message_id=post.message_id)
 
 
+async def test_db_posts_fake(fake_db):
+    await check_db_posts(fake_db)
+
+
+# Yep, insert in prod DB. Type "test" should not interfere with
+# working bot. Only with TEST_PROD_DB=1
+
+
+@pytest.mark.skipif(
+    not getenv('TEST_PROD_DB'),
+    reason='writes to prod DB, set TEST_PROD_DB=1'
+)
+async def test_db_posts(db):
+    await check_db_posts(db)
+
+
 #####
 #
 #   BOT
@@ -104,6 +794,8 @@ class FakeBot(Bot):
         if message_id not in self.chat_messages:
             raise BadRequest.detect('Message to forward not found')
 
+        return Message(message_id=len(self.trace))
+
     async def get_chat_member(self, chat_id, user_id):
         data = dict(chat_id=chat_id, user_id=user_id)
         await self.request('getChatMember', data)
@@ -124,10 +816,30 @@ class FakeDB(DB):
     def __init__(self):
         DB.__init__(self)
         self.posts = []
+        self.members = {}
+        self.members_index = True
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
 
     async def read_posts(self):
         return self.posts
 
+    async def read_posts_by_type(self, type, start=None, limit=None):
+        return select_posts(self.posts, type, start, limit)
+
+    async def get_post(self, message_id):
+        return find_post(self.posts, message_id=message_id)
+
+    async def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def put_member(self, user_id, status):
+        self.members[user_id] = status
+
     async def put_post(self, post):
         self.posts.append(post)
 
@@ -137,12 +849,23 @@ class FakeDB(DB):
             if _.message_id != message_id
         ]
 
+    async def delete_posts(self, message_ids):
+        for message_id in message_ids:
+            await self.delete_post(message_id)
+
 
 class FakeBotContext(BotContext):
     def __init__(self):
-        self.bot = FakeBot('123:faketoken')
-        self.dispatcher = Dispatcher(self.bot)
-        self.db = FakeDB()
+        BotContext.__init__(
+            self,
+            bot=FakeBot('123:faketoken'),
+            db=FakeDB(),
+            workers=0,
+            write_window=0,
+            webhook_reply=True,
+            profiler=Profiler(rate=0, slow=0),
+            memory=MemoryTracker(trace=0)
+        )
 
 
 @pytest.fixture(scope='function')
@@ -157,10 +880,20 @@ def context():
     return context
 
 
+# Handler may return reply for webhook response, trace it like
+# request
+
+
 async def process_update(context, json):
     data = parse_json(json)
     update = Update(**data)
-    await context.dispatcher.process_update(update)
+
+    # Like webhook, with pre_process_update middlewares
+    results = await context.dispatcher.updates_handler.notify(update)
+    for result in chain.from_iterable(results):
+        if isinstance(result, BaseResponse):
+            json = format_json(result.cleanup(), ensure_ascii=False)
+            context.bot.trace.append([result.method, json])
 
 
 def match_trace(trace, etalon):
@@ -199,7 +932,6 @@ async def test_bot_start_check_chat_member(context):
     assert match_trace(context.bot.trace, [
         ['getChatMember', '{"chat_id":'],
         ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
-        ['setMyCommands', '{"commands": "[{\\"command\\": \\"future']
     ])
 
 
@@ -209,10 +941,210 @@ async def test_bot_start_is_chat_member(context):
     assert match_trace(context.bot.trace, [
         ['getChatMember', '{"chat_id":'],
         ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
-        ['setMyCommands', '{"commands": ']
     ])
 
 
+async def test_bot_setup_commands(context):
+    await context.setup_commands()
+    assert match_trace(context.bot.trace, [
+        ['setMyCommands', '{"commands": "[{\\"command\\": \\"future']
+    ])
+
+
+async def test_bot_setup_commands_fail(context, caplog):
+    async def set_my_commands(commands):
+        raise RetryAfter(1)
+
+    context.bot.set_my_commands = set_my_commands
+    await setup_commands_background(context)
+    assert 'Failed set commands' in caplog.text
+
+
+async def test_bot_start_no_webhook_reply(context):
+    context.webhook_reply = False
+    context.bot.chat_members = [113947584]
+    await process_update(context, START_JSON)
+    assert match_trace(context.bot.trace, [
+        ['getChatMember', '{"chat_id":'],
+        ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
+    ])
+
+
+async def test_bot_start_duplicate(context):
+    context.bot.chat_members = [113947584]
+    await process_update(context, START_JSON)
+    await process_update(context, START_JSON)
+    assert match_trace(context.bot.trace, [
+        ['getChatMember', '{"chat_id":'],
+        ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
+    ])
+
+
+async def test_bot_start_redelivery_after_error(context):
+    async def get_member(user_id):
+        raise ClientError({'Error': {'Code': 'Throttled'}}, 'GetItem')
+
+    context.bot.chat_members = [113947584]
+    get_member_ok = context.db.get_member
+    context.db.get_member = get_member
+    with pytest.raises(ClientError):
+        await process_update(context, START_JSON)
+
+    # Webhook answered 500, Telegram sends same update again
+    context.db.get_member = get_member_ok
+    await process_update(context, START_JSON)
+    assert match_trace(context.bot.trace, [
+        ['getChatMember', '{"chat_id":'],
+        ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
+    ])
+
+
+async def test_dedup_shared_unmark(context):
+    context.db = FaultyDB(MemoryDB(), latency=0, errors=1, seed=1)
+    dedup = DedupMiddleware(context, shared=True)
+    with pytest.raises(ClientError):
+        await dedup.is_new(1)
+    assert len(dedup.window) == 0
+
+    context.db = MemoryDB()
+    assert await dedup.is_new(1)
+    await dedup.on_pre_process_error(
+        Update(update_id=1), ValueError(), {}
+    )
+    assert len(dedup.window) == 0
+    assert await dedup.is_new(1)
+
+
+def test_update_window():
+    window = UpdateWindow(size=2)
+    assert window.add(1)
+    assert not window.add(1)
+    assert window.add(2)
+    assert window.add(3)
+    assert window.add(1)
+    assert len(window) == 2
+
+    window.discard(1)
+    assert window.add(1)
+    assert window.order == deque([3, 1])
+
+
+def next_update(json):
+    return json.replace('"update_id": 767558049', '"update_id": 767558060')
+
+
+async def test_bot_start_member_cache(context):
+    context.bot.chat_members = [113947584]
+    await process_update(context, START_JSON)
+    await process_update(context, next_update(START_JSON))
+    methods = [method for method, _ in context.bot.trace]
+    assert methods.count('getChatMember') == 1
+
+
+async def test_member_cache():
+    cache = MemberCache(ttl=60, not_member_ttl=0, size=2)
+    calls = []
+
+    async def fetch(user_id, is_member):
+        calls.append(user_id)
+        await asyncio.sleep(0)
+        return is_member
+
+    results = await asyncio.gather(*[
+        cache.check(1, lambda: fetch(1, True))
+        for _ in range(3)
+    ])
+    assert results == [True] * 3
+    assert calls == [1]
+    assert cache.flight.coalesced == 2
+
+    # Not member expires at once
+    assert not await cache.check(2, lambda: fetch(2, False))
+    assert not await cache.check(2, lambda: fetch(2, False))
+    assert calls == [1, 2, 2]
+
+    await cache.check(3, lambda: fetch(3, True))
+    await cache.check(4, lambda: fetch(4, True))
+    assert list(cache.items) == [3, 4]
+    assert cache.evictions == 1
+
+
+CHAT_MEMBER_JSON = '{"update_id": 767558052, "chat_member": {"chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "from": {"id": 113947584, "is_bot": false, "first_name": "Alexander"}, "date": 1657879275, "old_chat_member": {"user": {"id": 113947584, "is_bot": false, "first_name": "Alexander"}, "status": "left"}, "new_chat_member": {"user": {"id": 113947584, "is_bot": false, "first_name": "Alexander"}, "status": "member"}}}'
+
+
+async def test_bot_chat_member_index(context):
+    await process_update(context, CHAT_MEMBER_JSON)
+    assert context.db.members == {113947584: 'member'}
+
+    await process_update(context, START_JSON)
+    assert match_trace(context.bot.trace, [
+        ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
+    ])
+
+    json = CHAT_MEMBER_JSON.replace(
+        '"update_id": 767558052', '"update_id": 767558053'
+    ).replace('"status": "member"', '"status": "kicked"')
+    await process_update(context, json)
+    context.bot.trace = []
+    await process_update(context, next_update(START_JSON))
+    assert match_trace(context.bot.trace, [
+        ['sendMessage', '"text": "Не нашел тебя в чате выпускников']
+    ])
+
+
+async def test_bot_chat_member_fallback(context):
+    context.bot.chat_members = [113947584]
+    await process_update(context, START_JSON)
+    assert context.db.members == {}
+    assert context.members.get(113947584)
+
+
+async def test_bot_chat_member_no_index(context):
+    context.db.members_index = False
+    await process_update(context, CHAT_MEMBER_JSON)
+    assert context.db.members == {}
+
+    context.members.items.clear()
+    context.bot.chat_members = [113947584]
+    await process_update(context, START_JSON)
+    assert match_trace(context.bot.trace, [
+        ['getChatMember', '{"chat_id":'],
+        ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
+    ])
+
+
+async def test_sender():
+    sender = Sender(
+        rate=1000, chat_rate=1000,
+        chat_burst=2, backoff=0.01
+    )
+    trace = []
+    retries = []
+
+    async def request(chat_id, index, delay=0):
+        await asyncio.sleep(delay)
+        if index == 1 and not retries:
+            retries.append(index)
+            raise RetryAfter(0)
+        trace.append((chat_id, index))
+
+    tasks = [
+        sender.send(1, lambda: request(1, 0, delay=0.01)),
+        sender.send(1, lambda: request(1, 1)),
+        sender.send(2, lambda: request(2, 0)),
+        sender.send(1, lambda: request(1, 2)),
+    ]
+    assert sender.pending == 4
+    assert sender.depths == {1: 3, 2: 1}
+
+    await asyncio.gather(*tasks)
+    assert trace == [(2, 0), (1, 0), (1, 1), (1, 2)]
+    assert sender.retried == 1
+    assert sender.pending == 0
+    assert sender.max_pending == 4
+    assert sender.lanes == {}
+
+
 ######
 #  OTHER
 #######
@@ -304,6 +1236,200 @@ async def test_bot_nav_ok(context):
 
 
 
+#######
+#   JOBS
+#####
+
+
+async def test_bot_reconcile(context):
+    context.bot.chat_messages = [22]
+    context.db.posts = [
+        Post(type='chats', message_id=22),
+        Post(type='contacts', message_id=23),
+    ]
+    await reconcile_posts(context, probe_chat_id=-1001)
+    assert context.db.posts == [
+        Post(type='chats', message_id=22),
+    ]
+    assert match_trace(sorted(context.bot.trace), [
+        ['deleteMessage', '{"chat_id": -1001, "message_id": 1}'],
+        ['forwardMessage', '"message_id": 22}'],
+        ['forwardMessage', '"message_id": 23}'],
+    ])
+
+
+async def test_periodic():
+    runs = []
+
+    async def job():
+        runs.append(1)
+        if len(runs) == 2:
+            raise ValueError
+
+    periodic = Periodic(0.001, job)
+    periodic.start()
+    await asyncio.sleep(0.05)
+    await periodic.close()
+    assert periodic.runs > 2
+    assert periodic.errors == 1
+
+
+#######
+#   WEBHOOK
+#####
+
+
+async def test_bot_webhook(context, aiohttp_client):
+    context.bot.chat_members = [113947584]
+    client = await aiohttp_client(context.make_app())
+    response = await client.post('/', data=START_JSON)
+    assert response.status == 200
+
+    # Reply in webhook response
+    data = await response.json()
+    assert data['method'] == 'sendMessage'
+    assert data['text'].startswith('Привет')
+
+
+async def test_bot_metrics(context, aiohttp_client):
+    context.bot.chat_members = [113947584]
+    client = await aiohttp_client(context.make_app())
+    await client.post('/', data=START_JSON)
+
+    response = await client.get('/metrics')
+    assert response.status == 200
+    text = await response.text()
+    assert 'handler_seconds_count{handler="handle_start_command"}' in text
+    assert (
+        'middleware_seconds_count{middleware="ChatMemberMiddleware",'
+        'action="pre_process_message"}'
+    ) in text
+    assert '# TYPE member_cache_misses_total counter' in text
+    assert 'member_cache_misses_total 1' in text
+    assert 'dedup_duplicates_total 0' in text
+    assert '# TYPE updates_queue_depth gauge' in text
+
+
+async def test_bot_profile(caplog):
+    context = FakeBotContext()
+    context.profiler = Profiler(rate=1, interval=0.001)
+    context.setup_handlers()
+    context.setup_middlewares()
+    context.bot.chat_members = [113947584]
+
+    async def slow_get_member(user_id):
+        # Busy loop thread, sampler should see it
+        for _ in range(10 ** 6):
+            pass
+
+    context.db.get_member = slow_get_member
+    Bot.set_current(context.bot)
+    Dispatcher.set_current(context.dispatcher)
+    context.profiler.start()
+    try:
+        await process_update(context, START_JSON)
+    finally:
+        context.profiler.close()
+
+    assert context.profiler.reported == 1
+    text = caplog.text
+    assert 'Profile update_id: ' in text
+    assert 'type: message' in text
+    assert 'slow_get_member' in text
+    assert '/start' not in text.split('Profile')[1]
+
+
+def test_profile_summary():
+    profiler = Profiler(top=2)
+
+    def code(name):
+        return compile(f'{name} = 1', f'/app/{name}.py', 'exec')
+
+    a, b, c = code('a'), code('b'), code('c')
+    profiler.samples.extend([
+        (0, (a, b)),
+        (1, (a, b)),
+        (2, (c, b)),
+        (3, (b,)),
+        (4, (a,)),
+    ])
+    count, idle, top = profiler.summary(1, 4)
+    assert count == 3
+    assert idle == 0
+    assert top == [
+        ('a.py:<module>:1', 1, 1),
+        ('c.py:<module>:1', 1, 1),
+    ]
+
+
+async def test_bot_memory(context, aiohttp_client):
+    context.memory = MemoryTracker(trace=1)
+    client = await aiohttp_client(context.make_app())
+
+    response = await client.get('/debug/memory')
+    text = await response.text()
+    assert 'rss_bytes ' in text
+    assert 'dedup_window_size 0' in text
+    assert 'snapshot 0\ntop\n' in text
+
+    garbage = [str(_) for _ in range(10000)]
+    response = await client.get('/debug/memory?base=0')
+    text = await response.text()
+    assert 'snapshot 1\ndiff to snapshot 0\n' in text
+    assert 'test.py' in text
+
+    # Snapshots 0..3 kept, oldest is still valid base
+    await client.get('/debug/memory')
+    await client.get('/debug/memory')
+    response = await client.get('/debug/memory?base=0')
+    assert 'snapshot 4\ndiff to snapshot 0\n' in await response.text()
+    response = await client.get('/debug/memory?base=0')
+    assert response.status == 400
+
+    response = await client.get('/debug/memory?base=x')
+    assert response.status == 400
+    response = await client.get('/debug/memory?base=100')
+    assert response.status == 400
+
+    response = await client.get('/metrics')
+    assert 'member_cache_size 0' in await response.text()
+    assert garbage
+
+
+async def test_bot_memory_no_trace(context, aiohttp_client):
+    client = await aiohttp_client(context.make_app())
+    response = await client.get('/debug/memory')
+    assert response.status == 404
+
+
+async def test_bot_webhook_queue(context, aiohttp_client):
+    context.bot.chat_members = [113947584]
+    context.updates = UpdateQueue(context.dispatcher, workers=2)
+    context.webhook_reply = False
+    client = await aiohttp_client(context.make_app())
+
+    response = await client.post('/', data=START_JSON)
+    assert response.status == 200
+    assert await response.text() == 'ok'
+
+    await context.updates.queue.join()
+    assert context.updates.processed == 1
+    assert match_trace(context.bot.trace, [
+        ['setMyCommands', '{"commands": '],
+        ['getChatMember', '{"chat_id":'],
+        ['sendMessage', '{"chat_id": 113947584, "text": "Привет'],
+    ])
+
+
+async def test_update_queue_full(context):
+    updates = UpdateQueue(context.dispatcher, workers=1, size=1)
+    update = Update(**parse_json(START_JSON))
+    assert updates.put(update)
+    assert not updates.put(update)
+    assert updates.dropped == 1
+    assert updates.max_depth == 1
+
+
 ########
 #   CHAT
 #####
@@ -319,3 +1445,66 @@ async def test_bot_chat_add_remove_footer(context):
     json = '{"update_id": 767558051, "edited_message": {"message_id": 22, "from": {"id": 113947584, "is_bot": false, "first_name": "Alexander", "last_name": "Kukushkin", "username": "alexkuk", "language_code": "ru"}, "sender_chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "date": 1657879275, "edit_date": 1657879298, "text": "Событие"}}'
     await process_update(context, json)
     assert context.db.posts == []
+
+
+CHAT_JSON = '{"update_id": 767558050, "message": {"message_id": 22, "from": {"id": 113947584, "is_bot": false, "first_name": "Alexander", "last_name": "Kukushkin", "username": "alexkuk", "language_code": "ru"}, "sender_chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "date": 1657879275, "text": "Событие #event 2030-08-01"}}'
+CHAT_EDIT_JSON = '{"update_id": 767558051, "edited_message": {"message_id": 22, "from": {"id": 113947584, "is_bot": false, "first_name": "Alexander", "last_name": "Kukushkin", "username": "alexkuk", "language_code": "ru"}, "sender_chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "chat": {"id": -1001432443813, "title": "shad15_bot_test_chat", "type": "supergroup"}, "date": 1657879275, "edit_date": 1657879298, "text": "Событие #event 2030-08-02"}}'
+
+
+async def test_bot_chat_coalesce_edits(context):
+    context.chat_writes = ChatWrites(context, window=0.01)
+    await process_update(context, CHAT_JSON)
+    for update_id, day in [(52, '03'), (53, '04')]:
+        json = CHAT_EDIT_JSON.replace(
+            '767558051', f'7675580{update_id}'
+        ).replace('2030-08-02', f'2030-08-{day}')
+        await process_update(context, json)
+    assert context.db.posts == []
+
+    await asyncio.sleep(0.05)
+    assert context.db.posts == [
+        Post(message_id=22, type='event', event_date=datetime.date(2030, 8, 4))
+    ]
+    assert context.chat_writes.submitted == 3
+    assert context.chat_writes.written == 1
+
+
+async def test_bot_chat_writes_in_order(context):
+    context.chat_writes = ChatWrites(context, window=0.01)
+    put_post = context.db.put_post
+
+    async def slow_put_post(post):
+        await asyncio.sleep(0.05)
+        await put_post(post)
+
+    context.db.put_post = slow_put_post
+    await context.chat_writes.submit(
+        22, PostFooter('event', Date(2030, 8, 1))
+    )
+    await asyncio.sleep(0.02)
+    await context.chat_writes.submit(22, None)
+    await asyncio.sleep(0.02)
+
+    # Delete waits for slow put
+    await context.chat_writes.close()
+    assert context.db.posts == []
+    assert context.chat_writes.writes == {}
+
+
+async def test_bot_chat_write_error(context):
+    async def put_post(post):
+        raise ClientError({'Error': {'Code': 'Throttled'}}, 'PutItem')
+
+    context.db.put_post = put_post
+    with pytest.raises(ClientError):
+        await process_update(context, CHAT_JSON)
+    assert context.chat_writes.written == 0
+
+
+async def test_bot_chat_flush_on_close(context):
+    context.chat_writes = ChatWrites(context, window=60)
+    await process_update(context, CHAT_JSON)
+    await context.chat_writes.close()
+    assert context.db.posts == [
+        Post(message_id=22, type='event', event_date=datetime.date(2030, 8, 1))
+    ]